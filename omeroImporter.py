@@ -4,14 +4,36 @@ import os
 import sys
 import time
 import json
+import csv
+import pickle
+import sqlite3
+import hashlib
+import base64
 import shutil
 import re
+import tempfile
+import importlib
+import multiprocessing
+import queue
+import threading
+import select
+import struct
+import ctypes
+import ctypes.util
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    wait,
+    as_completed,
+    FIRST_COMPLETED,
+)
+import numpy as np
 import pandas as pd
 import xlrd
+import yaml
 
 # BACKBLAZE
 import boto3  # REQUIRED! - Details here: https://pypi.org/project/boto3/
-from botocore.exceptions import ClientError
 from botocore.config import Config
 
 # from dotenv import load_dotenv  # Project Must install Python Package:  python-dotenv
@@ -35,24 +57,39 @@ from omero.gateway import (
     ProjectWrapper,
     DatasetWrapper,
     ImageWrapper,
-    MapAnnotationWrapper,
-    TagAnnotationWrapper,
 )
 from omero.model import (
     ProjectI,
     DatasetI,
     ImageI,
     ProjectDatasetLinkI,
+    DatasetImageLinkI,
+    TagAnnotationI,
+    MapAnnotationI,
+    NamedValue,
+    ProjectAnnotationLinkI,
+    DatasetAnnotationLinkI,
+    ImageAnnotationLinkI,
 )
 from omero.gateway import BlitzGateway
+from omero.cli import CLI
+from omero.plugins.sessions import SessionsControl
+from omero.sys import ParametersI
+from omero.rtypes import rstring, rlist, unwrap
+
+ImportControl = importlib.import_module("omero.plugins.import").ImportControl
 
 dateFormatter = "%d-%m-%Y_%H-%M-%S"
 
 outputPreviousImportedFileName = "OmeroImporter_previousImported.txt"
+outputFingerprintsFileName = "OmeroImporter_fingerprints.txt"
+outputImportedStoreFileName = "OmeroImporter_imported.db"
+outputJournalFilePrefix = "OmeroImporter_journal_"
 outputLogFileName = "OmeroImporter_log.txt"
 # outputMetadataLogFileName = "OmeroImporter_metadata_log.txt"
 outputImportedFileName = "OmeroImporter_imported.txt"
 # outputMetadataFileName = "OmeroImporter_metadata.txt"
+metadataFileName = "OmeroImporter_metadata.json"
 configFileFolder = "OmeroImporter"
 configFileName = "OmeroImporter.cfg"
 keyFileName = "OmeroImporter.key"
@@ -72,11 +109,15 @@ p_dest = "destination"
 # p_headless = "headless"
 p_delete = "hasDelete"
 p_mma = "hasMMA"
+p_dedupe = "hasDedupe"
 p_b2 = "hasB2"
 p_b2_endpoint = "b2Endpoint"
 p_b2_bucketName = "b2BucketName"
 p_b2_appKeyId = "b2AppKeyId"
 p_b2_appKey = "b2AppKey"
+p_b2_chunkSize = "b2ChunkSize"
+p_b2_partWorkers = "b2PartWorkers"
+p_b2_fileWorkers = "b2FileWorkers"
 p_userEmail = "userEmail"
 p_adminsEmail = "adminsEmail"
 p_emailFrom = "senderEmail"
@@ -84,14 +125,26 @@ p_emailFromPSW = "sendEmailPSW"
 p_startTime = "startTime"
 p_endTime = "endTime"
 p_key = "key"
+p_importWorkers = "importWorkers"
+p_userWorkers = "userWorkers"
+p_importChunkSize = "importChunkSize"
+p_copyWorkers = "copyWorkers"
+p_metadataWorkers = "metadataWorkers"
+p_isAdmin = "isAdmin"
+p_localPath = "localPath"
 
 import_status = "import"
 import_status_imported = "imported"
 import_status_pimported = "previously imported"
 import_status_found = "found"
+import_status_duplicate = "duplicate"
 import_status_id = "id"
 import_path = "path"
 import_annotate = "annotated"
+import_checksum = "checksum"
+import_kvhash = "kvhash"
+import_copied = "copied"
+import_uploaded = "uploaded"
 
 metadata_datasets = "datasets"
 metadata_images = "images"
@@ -113,12 +166,670 @@ excel_key = "Key"
 excel_value = "Value"
 excel_replaceNaN = "EMPTY-PD-VALUE"
 
+csv_module = "General"
+csv_section = "- "
+csv_imageSection = "- IMAGE"
+csv_tagSeparator = "#"
+
+userSessionTimeout = 12 * 60 * 60 * 1000
+omeroBatchSize = 500
+copyBufferSize = 16 * 1024 * 1024
+b2_checksumKey = "large_file_sha1"
+
+watchCheckSeconds = 10
+watchPollSeconds = 60
+watchStableSeconds = 60
+networkFileSystems = [
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smbfs",
+    "smb3",
+    "fuse.sshfs",
+    "ceph",
+    "glusterfs",
+    "lustre",
+    "9p",
+]
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+inotifyWatchMask = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+
 
 class WrappedException(Exception):
     def __init__(self, info, e):
         self.exception = e
+        self.message = info
         super().__init__(info)
 
+    # Keep the wrapped exception when raised from a worker process
+    def __reduce__(self):
+        return (WrappedException, (self.message, self.exception))
+
+
+# Keep a single sudo connection open for a user, a new session is only
+# created when the previous one has expired
+class UserSession:
+    def __init__(self, conn, userName):
+        self.conn = conn
+        self.userName = userName
+        self.userConn = None
+
+    def get(self):
+        if self.userName == None:
+            return self.conn
+        if self.userConn != None and not self.userConn.keepAlive():
+            message = "Session expired for user " + self.userName + ", reconnecting"
+            writeToLog(message)
+            printToConsole(message)
+            self.close()
+        if self.userConn == None:
+            self.userConn = self.conn.suConn(self.userName, ttl=userSessionTimeout)
+            self.userConn.c.enableKeepAlive(60)
+        return self.userConn
+
+    def close(self):
+        if self.userConn == None:
+            return
+        try:
+            self.userConn.close()
+        except Exception as e:
+            writeToLog(repr(e))
+        self.userConn = None
+
+
+# Sessions of the import workers, the gateway of the user folder is used by
+# the main thread while images are imported and ezomero switches its group
+# for some calls, each import runs with a session of its own, reused by the
+# following imports
+class ImportSessions:
+    def __init__(self, userSession, connect):
+        self.userSession = userSession
+        self.connect = connect
+        self.idleConns = queue.Queue()
+        self.conns = []
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.userSession.userName == None:
+            conn = self.connect()
+            if conn == None:
+                raise IOError("Connection error for an import session")
+        else:
+            conn = self.userSession.conn.suConn(
+                self.userSession.userName, ttl=userSessionTimeout
+            )
+        conn.c.enableKeepAlive(60)
+        with self.lock:
+            self.conns.append(conn)
+        return conn
+
+    # Run function with a session as its first argument
+    def run(self, function, *args):
+        try:
+            conn = self.idleConns.get_nowait()
+            if not conn.keepAlive():
+                self.closeConn(conn)
+                conn = self.open()
+        except queue.Empty:
+            conn = self.open()
+        try:
+            return function(conn, *args)
+        finally:
+            self.idleConns.put(conn)
+
+    def closeConn(self, conn):
+        with self.lock:
+            self.conns.remove(conn)
+        try:
+            conn.close()
+        except Exception as e:
+            writeToLog(repr(e))
+
+    def close(self):
+        for conn in list(self.conns):
+            self.closeConn(conn)
+
+
+# Hash of the key-value list of a map annotation, to tell if it changed
+# since it was written
+def getKeyValueHash(keyValueData):
+    return hashlib.sha1(json.dumps(keyValueData).encode("utf8")).hexdigest()
+
+
+# Stage the map annotations of projects, datasets and images and the tag
+# links of images so that they are written with a few batched update
+# service calls
+class AnnotationBatch:
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.created = []
+        self.updated = []
+        self.tagLinks = []
+
+    def create(self, objectType, objectID, keyValueData, record, qName):
+        self.created.append((objectType, objectID, keyValueData, record, qName))
+
+    def update(self, objectType, objectID, annotationID, keyValueData, record, qName):
+        if annotationID == None:
+            self.create(objectType, objectID, keyValueData, record, qName)
+            return
+        self.updated.append((objectID, annotationID, keyValueData, record, qName))
+
+    def linkTags(self, imageID, tagIDs, qName):
+        self.tagLinks.append((imageID, tagIDs, qName))
+
+    def flush(self, conn, datasetID=None):
+        updateService = conn.getUpdateService()
+        for i in range(0, len(self.created), omeroBatchSize):
+            chunk = self.created[i : i + omeroBatchSize]
+            links = []
+            for objectType, objectID, keyValueData, record, qName in chunk:
+                mapAnn = MapAnnotationI()
+                mapAnn.setNs(rstring(self.namespace))
+                mapAnn.setMapValue(getNamedValues(keyValueData))
+                links.append(newAnnotationLink(objectType, objectID, mapAnn))
+            savedLinks = updateService.saveAndReturnArray(links, conn.SERVICE_OPTS)
+            for j in range(0, len(chunk)):
+                objectType, objectID, keyValueData, record, qName = chunk[j]
+                record[import_annotate] = savedLinks[j].getChild().getId().val
+                record[import_kvhash] = getKeyValueHash(keyValueData)
+                writeToLog(
+                    "Annotation created for " + qName + " (" + str(objectID) + ")"
+                )
+        for i in range(0, len(self.updated), omeroBatchSize):
+            chunk = self.updated[i : i + omeroBatchSize]
+            params = ParametersI()
+            params.addIds([annotationID for _, annotationID, _, _, _ in chunk])
+            mapAnns = conn.getQueryService().findAllByQuery(
+                "select m from MapAnnotation m where m.id in (:ids)",
+                params,
+                conn.SERVICE_OPTS,
+            )
+            mapAnnsByID = {}
+            for mapAnn in mapAnns:
+                mapAnnsByID[mapAnn.getId().val] = mapAnn
+            for objectID, annotationID, keyValueData, record, qName in chunk:
+                if annotationID not in mapAnnsByID:
+                    writeToLog(
+                        "ERROR: Annotation "
+                        + str(annotationID)
+                        + " not found for "
+                        + qName
+                        + " ("
+                        + str(objectID)
+                        + ")"
+                    )
+                    continue
+                mapAnnsByID[annotationID].setMapValue(getNamedValues(keyValueData))
+                record[import_annotate] = annotationID
+                record[import_kvhash] = getKeyValueHash(keyValueData)
+            updateService.saveArray(list(mapAnnsByID.values()), conn.SERVICE_OPTS)
+            for objectID, annotationID, keyValueData, record, qName in chunk:
+                if annotationID in mapAnnsByID:
+                    writeToLog(
+                        "Annotation updated for " + qName + " (" + str(objectID) + ")"
+                    )
+        if len(self.tagLinks) > 0:
+            existingLinks = set()
+            if datasetID != None:
+                existingLinks = getImageAnnotationLinks(conn, datasetID)
+            links = []
+            for imageID, tagIDs, qName in self.tagLinks:
+                for tagID in tagIDs:
+                    if (imageID, tagID) in existingLinks:
+                        continue
+                    existingLinks.add((imageID, tagID))
+                    links.append(
+                        newAnnotationLink(
+                            "Image", imageID, TagAnnotationI(tagID, False)
+                        )
+                    )
+            for i in range(0, len(links), omeroBatchSize):
+                updateService.saveArray(
+                    links[i : i + omeroBatchSize], conn.SERVICE_OPTS
+                )
+            for imageID, tagIDs, qName in self.tagLinks:
+                writeToLog("Tags created for " + qName + " (" + str(imageID) + ")")
+        self.created = []
+        self.updated = []
+        self.tagLinks = []
+
+
+# Run the stages of the transfer of imported files, each with its own worker
+# threads, connected by bounded queues so that the slowest stage sets the
+# pace, an item that fails a stage skips the following stages
+class TransferPipeline:
+    # Items reaching a stage after the end time of the time window are left
+    # pending for the next run to resume their transfers
+    def __init__(self, timeWindow=None):
+        self.stages = []
+        self.failures = []
+        self.pending = []
+        self.timeWindow = timeWindow
+        self.lock = threading.Lock()
+
+    def addStage(self, name, function, workers, args=()):
+        stage = {
+            "name": name,
+            "function": function,
+            "args": args,
+            "queue": queue.Queue(maxsize=2 * workers),
+            "threads": [],
+        }
+        self.stages.append(stage)
+        for i in range(0, workers):
+            thread = threading.Thread(
+                target=self.work, args=(len(self.stages) - 1,), daemon=True
+            )
+            thread.start()
+            stage["threads"].append(thread)
+
+    def put(self, item):
+        if len(self.stages) == 0:
+            return
+        self.stages[0]["queue"].put(item)
+
+    def work(self, index):
+        stage = self.stages[index]
+        while True:
+            item = stage["queue"].get()
+            if item == None:
+                break
+            if self.timeWindow != None and isEndTimePassed(*self.timeWindow):
+                with self.lock:
+                    self.pending.append((stage["name"], item))
+                continue
+            try:
+                stage["function"](item, *stage["args"])
+            except Exception as e:
+                writeToLog("ERROR: " + stage["name"] + " failed for " + item["qname"])
+                writeToLog(repr(e))
+                with self.lock:
+                    self.failures.append((stage["name"], item, repr(e)))
+                continue
+            if index + 1 < len(self.stages):
+                self.stages[index + 1]["queue"].put(item)
+
+    # Wait for all the items to go through or be left pending, returns the
+    # failed items
+    def close(self):
+        for stage in self.stages:
+            for thread in stage["threads"]:
+                stage["queue"].put(None)
+            for thread in stage["threads"]:
+                thread.join()
+        return self.failures
+
+
+# Return the user/project folders of the target directory
+def getProjectPaths(targetPath):
+    projectPaths = []
+    for userPath in targetPath.iterdir():
+        if not userPath.is_dir():
+            continue
+        for projectPath in userPath.iterdir():
+            if projectPath.is_dir():
+                projectPaths.append(projectPath)
+    return projectPaths
+
+
+# Return the user/project folder a path of the target directory belongs to,
+# None for the target and user folders and the files of user folders
+def getProjectPath(targetPath, path):
+    try:
+        parts = pathlib.Path(path).relative_to(targetPath).parts
+    except ValueError:
+        return None
+    if len(parts) < 2:
+        return None
+    projectPath = targetPath / parts[0] / parts[1]
+    if len(parts) == 2 and not projectPath.is_dir():
+        # a file of the user folder, like its config file
+        return None
+    return projectPath
+
+
+# Return whether a path is on a network file system, where inotify doesn't
+# see the changes made by other hosts
+def isNetworkFileSystem(path):
+    try:
+        with open("/proc/mounts", "r") as f:
+            mounts = [line.split() for line in f]
+    except (IOError, OSError):
+        return False
+    path = str(path)
+    fileSystem = None
+    mountPointLength = -1
+    for mount in mounts:
+        if len(mount) < 3:
+            continue
+        mountPoint = mount[1].replace("\\040", " ")
+        if path != mountPoint and not path.startswith(mountPoint.rstrip("/") + "/"):
+            continue
+        if len(mountPoint) > mountPointLength:
+            mountPointLength = len(mountPoint)
+            fileSystem = mount[2]
+    return fileSystem in networkFileSystems
+
+
+# Report the project folders changed under the target directory from the
+# inotify events of all its directories
+class InotifyWatcher:
+    def __init__(self, targetPath):
+        self.targetPath = targetPath
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+        self.addWatches(targetPath)
+
+    def addWatches(self, path):
+        for dirPath, dirNames, fileNames in os.walk(path):
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirPath), inotifyWatchMask
+            )
+            if wd < 0:
+                # ENOSPC when fs.inotify.max_user_watches is reached
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), dirPath)
+            self.watches[wd] = dirPath
+
+    def poll(self, timeout):
+        changedPaths = set()
+        select.select([self.fd], [], [], timeout)
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16 : offset + 16 + length].rstrip(b"\0")
+                offset = offset + 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, every project folder is a candidate
+                    changedPaths.update(getProjectPaths(self.targetPath))
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if wd not in self.watches:
+                    continue
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.addWatches(path)
+                projectPath = getProjectPath(self.targetPath, path)
+                if projectPath != None:
+                    changedPaths.add(projectPath)
+        return changedPaths
+
+
+# Report the project folders changed under the target directory by
+# comparing their fingerprints, for NFS and systems without inotify
+class PollingWatcher:
+    def __init__(self, targetPath):
+        self.targetPath = targetPath
+        self.fingerprints = self.getFingerprints()
+
+    def getFingerprints(self):
+        fingerprints = {}
+        for projectPath in getProjectPaths(self.targetPath):
+            fingerprints[projectPath] = getFolderFingerprint(projectPath)
+        return fingerprints
+
+    def poll(self, timeout):
+        time.sleep(max(timeout, watchPollSeconds))
+        fingerprints = self.getFingerprints()
+        changedPaths = set()
+        for projectPath in fingerprints:
+            if fingerprints[projectPath] != self.fingerprints.get(projectPath):
+                changedPaths.add(projectPath)
+        self.fingerprints = fingerprints
+        return changedPaths
+
+
+# Imported projects, datasets and images of all the runs in a SQLite
+# database, a table per level keyed by the user, project, dataset and image
+# names. The records keep the keys of the imported files, the values already
+# stored win over the new ones, like the previous imported file merge did,
+# except for the hash of the annotation which follows its last write
+class ImportedStore:
+    keyColumns = {
+        "projects": ["user", "project"],
+        "datasets": ["user", "project", "dataset"],
+        "images": ["user", "project", "dataset", "image"],
+    }
+    valueColumns = {
+        import_status_id: "id",
+        import_status: "status",
+        import_path: "path",
+        import_annotate: "annotated",
+        import_checksum: "checksum",
+        import_kvhash: "kvhash",
+    }
+    latestColumns = ["kvhash"]
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("pragma journal_mode=wal")
+        with self.conn:
+            for table in self.keyColumns:
+                keyColumns = self.keyColumns[table]
+                self.conn.execute(
+                    "create table if not exists "
+                    + table
+                    + " ("
+                    + ", ".join(column + " text not null" for column in keyColumns)
+                    + ", id integer, status text, path text, annotated integer,"
+                    + " checksum text, kvhash text, data text, primary key ("
+                    + ", ".join(keyColumns)
+                    + "))"
+                )
+                # stores created before the annotation hash
+                columns = self.conn.execute("pragma table_info(" + table + ")")
+                if "kvhash" not in [column[1] for column in columns.fetchall()]:
+                    self.conn.execute(
+                        "alter table " + table + " add column kvhash text"
+                    )
+            self.conn.execute(
+                "create index if not exists images_checksum on images (user, checksum)"
+            )
+            self.conn.execute(
+                "create table if not exists spreadsheets (path text primary key,"
+                + " size integer, mtime real, checksum text, data blob)"
+            )
+
+    def close(self):
+        self.conn.close()
+
+    def isEmpty(self):
+        row = self.conn.execute("select count(*) from projects").fetchone()
+        return row[0] == 0
+
+    def getRecord(self, row):
+        record = {}
+        if row[-1] != None:
+            record.update(json.loads(row[-1]))
+        for key, value in zip(self.valueColumns, row):
+            if value != None:
+                record[key] = value
+        return record
+
+    def getRows(self, table, keys):
+        keyColumns = self.keyColumns[table][: len(keys)]
+        query = (
+            "select "
+            + ", ".join(self.valueColumns.values())
+            + ", data, "
+            + self.keyColumns[table][-1]
+            + " from "
+            + table
+            + " where "
+            + " and ".join(column + " = ?" for column in keyColumns)
+        )
+        return self.conn.execute(query, keys).fetchall()
+
+    def getProject(self, user, project):
+        rows = self.getRows("projects", [user, project])
+        if len(rows) == 0:
+            return None
+        return self.getRecord(rows[0][:-1])
+
+    def getDataset(self, user, project, dataset):
+        rows = self.getRows("datasets", [user, project, dataset])
+        if len(rows) == 0:
+            return None
+        return self.getRecord(rows[0][:-1])
+
+    # Return the records of the images of a dataset by image name
+    def getImages(self, user, project, dataset):
+        images = {}
+        for row in self.getRows("images", [user, project, dataset]):
+            images[row[-1]] = self.getRecord(row[:-1])
+        return images
+
+    def getChecksumIndex(self, user):
+        rows = self.conn.execute(
+            "select checksum, id from images where user = ? and checksum is not null",
+            [user],
+        )
+        return dict(rows.fetchall())
+
+    def upsert(self, table, keys, record):
+        values = [None] * len(self.valueColumns)
+        data = {}
+        for key in record:
+            if isinstance(record[key], dict):
+                continue
+            if key in self.valueColumns:
+                values[list(self.valueColumns).index(key)] = record[key]
+            else:
+                data[key] = record[key]
+        if len(data) > 0:
+            values.append(json.dumps(data))
+        else:
+            values.append(None)
+        columns = self.keyColumns[table] + list(self.valueColumns.values())
+        updates = []
+        for column in self.valueColumns.values():
+            existing = table + "." + column
+            new = "excluded." + column
+            if column in self.latestColumns:
+                updates.append(column + " = coalesce(" + new + ", " + existing + ")")
+            else:
+                updates.append(column + " = coalesce(" + existing + ", " + new + ")")
+        query = (
+            "insert into "
+            + table
+            + " ("
+            + ", ".join(columns)
+            + ", data) values ("
+            + ", ".join(["?"] * (len(columns) + 1))
+            + ") on conflict ("
+            + ", ".join(self.keyColumns[table])
+            + ") do update set "
+            + ", ".join(updates)
+            + ", data = case when "
+            + table
+            + ".data is null then excluded.data when excluded.data is null then "
+            + table
+            + ".data else json_patch(excluded.data, "
+            + table
+            + ".data) end"
+        )
+        self.conn.execute(query, list(keys) + values)
+
+    # Return the parsed data of a spreadsheet if it is cached for the same
+    # size, modification time and checksum, None otherwise
+    def getSpreadsheet(self, path, size, mtime, checksum):
+        row = self.conn.execute(
+            "select data from spreadsheets where path = ? and size = ?"
+            + " and mtime = ? and checksum = ?",
+            [path, size, mtime, checksum],
+        ).fetchone()
+        if row == None:
+            return None
+        return pickle.loads(row[0])
+
+    def putSpreadsheet(self, path, size, mtime, checksum, data):
+        with self.conn:
+            self.conn.execute(
+                "insert or replace into spreadsheets (path, size, mtime, checksum,"
+                + " data) values (?, ?, ?, ?, ?)",
+                [path, size, mtime, checksum, pickle.dumps(data)],
+            )
+
+    # Store the imported files of a user in one transaction
+    def putUserData(self, user, userData):
+        with self.conn:
+            for projectKey in userData:
+                projectData = userData[projectKey]
+                if not isinstance(projectData, dict):
+                    continue
+                self.upsert("projects", [user, projectKey], projectData)
+                for datasetKey in projectData:
+                    datasetData = projectData[datasetKey]
+                    if not isinstance(datasetData, dict):
+                        continue
+                    self.upsert("datasets", [user, projectKey, datasetKey], datasetData)
+                    for imageKey in datasetData:
+                        imageData = datasetData[imageKey]
+                        if not isinstance(imageData, dict):
+                            continue
+                        self.upsert(
+                            "images",
+                            [user, projectKey, datasetKey, imageKey],
+                            imageData,
+                        )
+
+
+# Append-only journal of the records of the objects imported for a user,
+# synced to disk on each append so that a crash loses none of them
+class ImportJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    # Append records given as (keys, record), keys being the project,
+    # dataset and image names of the record
+    def append(self, entries):
+        with self.lock:
+            for keys, record in entries:
+                values = {}
+                for key in record:
+                    if not isinstance(record[key], dict):
+                        values[key] = record[key]
+                self.file.write(json.dumps({"keys": keys, "record": values}) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
 
 # Return a boto3 client object for B2 service
 def get_b2_client(endpoint, keyID, applicationKey):
@@ -132,7 +843,7 @@ def get_b2_client(endpoint, keyID, applicationKey):
 
 
 # Return a boto3 resource object for B2 service
-def get_b2_resource(endpoint, keyID, applicationKey):
+def get_b2_resource(endpoint, keyID, applicationKey, maxPoolConnections=10):
     b2 = boto3.resource(
         service_name="s3",
         endpoint_url=endpoint,
@@ -140,30 +851,714 @@ def get_b2_resource(endpoint, keyID, applicationKey):
         aws_secret_access_key=applicationKey,
         config=Config(
             signature_version="s3v4",
+            max_pool_connections=maxPoolConnections,
         ),
     )
     return b2
 
 
-def upload_file(bucketName, filePath, fileName, b2, b2path=None):
+# Return the key of a file in the bucket
+def getRemotePath(fileName, b2path=None):
+    if b2path is None:
+        return fileName
+    return re.sub(r"\\", "/", b2path)
+
+
+# Return if a file uploaded by a previous run is complete in the bucket, the
+# checksum of the file must match the one recorded in the metadata of the
+# object, an upload left unfinished is resumed by upload_file
+def isUploadComplete(bucketName, filePath, b2path, b2, checksum):
+    b2_client = b2.meta.client
+    remotePath = getRemotePath(os.path.basename(filePath), b2path)
+    uploadID, uploadedParts = get_unfinished_upload(b2_client, bucketName, remotePath)
+    if uploadID != None:
+        return False
+    response = b2_client.list_objects_v2(Bucket=bucketName, Prefix=remotePath)
+    for remoteObject in response.get("Contents", []):
+        if remoteObject["Key"] != remotePath:
+            continue
+        if remoteObject["Size"] != os.path.getsize(filePath):
+            return False
+        if checksum == None:
+            checksum = getFileChecksum(filePath)
+        response = b2_client.head_object(Bucket=bucketName, Key=remotePath)
+        return response.get("Metadata", {}).get(b2_checksumKey) == checksum
+    return False
+
+
+# Uploads a file in parts of chunkSize bytes, partWorkers parts at a time,
+# resuming the multipart upload left unfinished for the same remote path.
+# The checksum of the file, computed unless it is given, is recorded in the
+# metadata of the object, returns the response and the checksum
+def upload_file(
+    bucketName,
+    filePath,
+    fileName,
+    b2,
+    b2path=None,
+    chunkSize=100 * 1024 * 1024,
+    partWorkers=1,
+    checksum=None,
+):
     # filePath = directory + '/' + file
-    remotePath = b2path
-    if remotePath is None:
-        remotePath = fileName
-    else:
-        remotePath = re.sub(r"\\", "/", remotePath)
+    remotePath = getRemotePath(fileName, b2path)
     printToConsole("remotePath " + remotePath)
+    b2_client = b2.meta.client
+    fileChecksum = hashlib.sha1()
+    size = os.path.getsize(filePath)
+    if size <= chunkSize:
+        with open(filePath, "rb") as f:
+            data = f.read()
+        fileChecksum.update(data)
+        if checksum != None and checksum != fileChecksum.hexdigest():
+            raise IOError("Checksum doesn't match for " + filePath)
+        response = b2_client.put_object(
+            Bucket=bucketName,
+            Key=remotePath,
+            Body=data,
+            ContentMD5=get_content_md5(data),
+            Metadata={b2_checksumKey: fileChecksum.hexdigest()},
+        )
+        return response, fileChecksum.hexdigest()
+
+    if checksum == None:
+        # recorded when the upload is created, before the parts are read
+        checksum = getFileChecksum(filePath)
+    partCount = (size + chunkSize - 1) // chunkSize
+    uploadID, uploadedParts = get_unfinished_upload(b2_client, bucketName, remotePath)
+    if uploadID != None and not areUploadedPartsValid(
+        filePath, uploadedParts, chunkSize, partCount
+    ):
+        # parts of another file content or chunk size, start over
+        b2_client.abort_multipart_upload(
+            Bucket=bucketName, Key=remotePath, UploadId=uploadID
+        )
+        uploadID = None
+        uploadedParts = {}
+    if uploadID == None:
+        response = b2_client.create_multipart_upload(
+            Bucket=bucketName, Key=remotePath, Metadata={b2_checksumKey: checksum}
+        )
+        uploadID = response["UploadId"]
+    else:
+        writeToLog(
+            "Resuming upload of "
+            + remotePath
+            + " with "
+            + str(len(uploadedParts))
+            + " of "
+            + str(partCount)
+            + " parts"
+        )
+
+    parts = [
+        {"PartNumber": partNumber, "ETag": uploadedParts[partNumber]["ETag"]}
+        for partNumber in uploadedParts
+    ]
+    # Parts are read in order and at most partWorkers of them are in flight,
+    # an interrupted upload is left open, the next run resumes it
+    with open(filePath, "rb") as f, ThreadPoolExecutor(
+        max_workers=partWorkers
+    ) as partExecutor:
+        partFutures = set()
+        for partNumber in range(1, partCount + 1):
+            if partNumber in uploadedParts:
+                f.seek(partNumber * chunkSize)
+                continue
+            data = f.read(chunkSize)
+            if len(partFutures) >= partWorkers:
+                doneFutures, partFutures = wait(
+                    partFutures, return_when=FIRST_COMPLETED
+                )
+                for future in doneFutures:
+                    parts.append(future.result())
+            partFutures.add(
+                partExecutor.submit(
+                    upload_part,
+                    b2_client,
+                    bucketName,
+                    remotePath,
+                    uploadID,
+                    partNumber,
+                    data,
+                )
+            )
+        for future in as_completed(partFutures):
+            parts.append(future.result())
+    parts.sort(key=lambda part: part["PartNumber"])
+    response = b2_client.complete_multipart_upload(
+        Bucket=bucketName,
+        Key=remotePath,
+        UploadId=uploadID,
+        MultipartUpload={"Parts": parts},
+    )
+    return response, checksum
+
+
+def upload_part(b2_client, bucketName, remotePath, uploadID, partNumber, data):
+    response = b2_client.upload_part(
+        Bucket=bucketName,
+        Key=remotePath,
+        UploadId=uploadID,
+        PartNumber=partNumber,
+        Body=data,
+        ContentMD5=get_content_md5(data),
+    )
+    return {"PartNumber": partNumber, "ETag": response["ETag"]}
+
+
+def get_content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+# Return if the parts uploaded by a previous run hold the content of the file
+# in parts of chunkSize bytes, the ETag of a part is the MD5 digest of its
+# content
+def areUploadedPartsValid(filePath, uploadedParts, chunkSize, partCount):
+    with open(filePath, "rb") as f:
+        for partNumber in sorted(uploadedParts):
+            if partNumber > partCount:
+                return False
+            f.seek((partNumber - 1) * chunkSize)
+            data = f.read(chunkSize)
+            part = uploadedParts[partNumber]
+            if part["Size"] != len(data):
+                return False
+            if part["ETag"].strip('"') != hashlib.md5(data).hexdigest():
+                return False
+    return True
+
+
+# Return the id and the uploaded parts of the last multipart upload left
+# unfinished for a remote path, None if there is none
+def get_unfinished_upload(b2_client, bucketName, remotePath):
+    response = b2_client.list_multipart_uploads(Bucket=bucketName, Prefix=remotePath)
+    uploads = [
+        upload for upload in response.get("Uploads", []) if upload["Key"] == remotePath
+    ]
+    if len(uploads) == 0:
+        return None, {}
+    uploadID = uploads[-1]["UploadId"]
+    uploadedParts = {}
+    partNumberMarker = 0
+    while True:
+        response = b2_client.list_parts(
+            Bucket=bucketName,
+            Key=remotePath,
+            UploadId=uploadID,
+            PartNumberMarker=partNumberMarker,
+        )
+        for part in response.get("Parts", []):
+            uploadedParts[part["PartNumber"]] = part
+        if not response.get("IsTruncated"):
+            break
+        partNumberMarker = response["NextPartNumberMarker"]
+    return uploadID, uploadedParts
+
+
+# Copy the content of a file in large blocks, the source is read once and
+# its checksum computed on the way, returns the checksum
+def copyFileContent(sourcePath, destPath):
+    checksum = hashlib.sha1()
+    with open(sourcePath, "rb") as sourceFile, open(destPath, "wb") as destFile:
+        while True:
+            buffer = sourceFile.read(copyBufferSize)
+            if not buffer:
+                break
+            checksum.update(buffer)
+            destFile.write(buffer)
+    return checksum.hexdigest()
+
+
+def getFileChecksum(path):
+    checksum = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            buffer = f.read(copyBufferSize)
+            if not buffer:
+                break
+            checksum.update(buffer)
+    return checksum.hexdigest()
+
+
+# Copy a file in a destination folder keeping its metadata, returns the
+# checksum of the source if the copy matches it and the checksum expected
+# for the source if any, None otherwise with the copy removed
+def copyFileVerified(sourcePath, destFolderPath, expectedChecksum=None):
+    destPath = os.path.join(destFolderPath, os.path.basename(sourcePath))
+    checksum = copyFileContent(sourcePath, destPath)
+    shutil.copystat(sourcePath, destPath)
+    if (expectedChecksum != None and checksum != expectedChecksum) or getFileChecksum(
+        destPath
+    ) != checksum:
+        os.remove(destPath)
+        return None
+    return checksum
+
+
+# Return if a copy made by a previous run has the size and modification
+# time of its source
+def isCopyComplete(sourcePath, destPath):
+    if not os.path.exists(destPath):
+        return False
+    sourceStat = os.stat(sourcePath)
+    destStat = os.stat(destPath)
+    return (
+        sourceStat.st_size == destStat.st_size
+        and sourceStat.st_mtime == destStat.st_mtime
+    )
+
+
+def copyStage(item):
+    copyPath = os.path.join(item["copyFolder"], os.path.basename(item["path"]))
+    # copies done by a previous run are not made again
+    if item.get(import_copied) or (
+        item.get("previous") and isCopyComplete(item["path"], copyPath)
+    ):
+        item["copyPath"] = copyPath
+        item["record"][import_copied] = True
+        item["journal"].append([(item["keys"], {import_copied: True})])
+        return
+    os.makedirs(item["copyFolder"], exist_ok=True)
+    # TODO copy mma file here?
+    # TODO regex imageName*.json?
+    # the digest taken before the import, with -dd, is checked by the copy
+    checksum = copyFileVerified(item["path"], item["copyFolder"], item.get("checksum"))
+    if checksum == None:
+        raise IOError("Checksum of the copy doesn't match " + item["path"])
+    item["copyPath"] = copyPath
+    item["checksum"] = checksum
+    item["record"][import_checksum] = checksum
+    item["record"][import_copied] = True
+    item["journal"].append(
+        [(item["keys"], {import_checksum: checksum, import_copied: True})]
+    )
+    writeToLog("Image copied for " + item["qname"])
+
+
+# The verified copy is uploaded when there is one, the source is then not
+# read again
+def uploadStage(item, bucketName, b2, chunkSize, partWorkers):
+    if item.get(import_uploaded) or (
+        item.get("previous")
+        and isUploadComplete(
+            bucketName,
+            item.get("copyPath", item["path"]),
+            item["qname"],
+            b2,
+            item.get("checksum"),
+        )
+    ):
+        item["record"][import_uploaded] = True
+        item["journal"].append([(item["keys"], {import_uploaded: True})])
+        return
+    response, checksum = upload_file(
+        bucketName,
+        item.get("copyPath", item["path"]),
+        item["name"],
+        b2,
+        item["qname"],
+        chunkSize,
+        partWorkers,
+        item.get("checksum"),
+    )
+    item["checksum"] = checksum
+    item["record"][import_checksum] = checksum
+    item["record"][import_uploaded] = True
+    item["journal"].append(
+        [(item["keys"], {import_checksum: checksum, import_uploaded: True})]
+    )
+    printToConsole("RESPONSE:  " + str(response))
+    # generate_friendly_url(NEW_BUCKET_NAME, endpoint, b2)
+    writeToLog("Image uploaded for " + item["qname"])
+
+
+def deleteStage(item):
+    # TODO directories not removed because of CSV and MMA files?
+    if os.path.exists(item["path"]):
+        os.remove(item["path"])
+
+
+# Import a single file with ezomero under the given image name, returns the
+# ids of the images created for the file path
+def importImageFile(conn, imagePath, projectID, datasetID, imageName):
+    imageIDs = ezome.ezimport(conn, imagePath, projectID, datasetID, name=imageName)
+    return {imagePath: imageIDs}
+
+
+# Import several files with a single OMERO CLI import, returns the ids of
+# the images created for each file path
+def importImageFiles(conn, imagePaths, datasetID):
+    cli = CLI()
+    cli.register("import", ImportControl, "_")
+    cli.register("sessions", SessionsControl, "_")
+    outputFile = tempfile.NamedTemporaryFile(mode="r", delete=False)
+    outputFile.close()
+    arguments = [
+        "import",
+        "-k",
+        conn.getSession().getUuid().val,
+        "-s",
+        conn.host,
+        "-p",
+        str(conn.port),
+        "-d",
+        str(datasetID),
+        "--file",
+        outputFile.name,
+        "--output",
+        "yaml",
+    ]
+    arguments.extend([str(imagePath) for imagePath in imagePaths])
     try:
-        response = b2.Bucket(bucketName).upload_file(filePath, remotePath)
-    except ClientError as ce:
-        raise
-    return response
+        cli.invoke(arguments)
+        with open(outputFile.name, "r") as f:
+            importResult = yaml.safe_load(f)
+    finally:
+        os.unlink(outputFile.name)
+    imageIDsByPath = {}
+    for imagePath in imagePaths:
+        imageIDsByPath[imagePath] = []
+    unmatchedImageIDs = []
+    if importResult != None:
+        for filesetResult in importResult:
+            imageIDs = filesetResult.get("Image", [])
+            imagePath = getImportedPath(filesetResult.get("path"), imagePaths)
+            if imagePath == None:
+                unmatchedImageIDs.extend(imageIDs)
+            else:
+                imageIDsByPath[imagePath].extend(imageIDs)
+    if len(unmatchedImageIDs) > 0:
+        clientPathImageIDs = getImageIDsByClientPath(
+            conn, unmatchedImageIDs, imagePaths
+        )
+        for imagePath in clientPathImageIDs:
+            imageIDsByPath[imagePath].extend(clientPathImageIDs[imagePath])
+    return imageIDsByPath
+
+
+# Return the file path of the import output path of a fileset, None if it
+# has none or it isn't one of the imported paths
+def getImportedPath(outputPath, imagePaths):
+    if outputPath == None:
+        return None
+    for imagePath in imagePaths:
+        if outputPath == str(imagePath):
+            return imagePath
+    for imagePath in imagePaths:
+        if os.path.realpath(outputPath) == os.path.realpath(imagePath):
+            return imagePath
+    return None
+
+
+# Return the OMERO client path of a local file path, the absolute path with
+# forward slashes and no leading slash
+def getClientPath(path):
+    clientPath = os.path.abspath(str(path)).replace("\\", "/")
+    return clientPath.lstrip("/")
+
+
+# Return the ids of the given images grouped by the file path they were
+# imported from, matching the full client paths of the image filesets
+def getImageIDsByClientPath(conn, imageIDs, imagePaths):
+    imageIDsByPath = {}
+    pathsByClientPath = {}
+    for imagePath in imagePaths:
+        imageIDsByPath[imagePath] = []
+        pathsByClientPath[getClientPath(imagePath)] = imagePath
+    if len(imageIDs) == 0:
+        return imageIDsByPath
+    params = ParametersI()
+    params.addIds(imageIDs)
+    query = (
+        "select i.id, e.clientPath from Image i join i.fileset f"
+        " join f.usedFiles e where i.id in (:ids) order by i.id"
+    )
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    for row in rows:
+        imageID = unwrap(row[0])
+        clientPath = unwrap(row[1]).lstrip("/")
+        imagePath = pathsByClientPath.get(clientPath)
+        if imagePath != None and imageID not in imageIDsByPath[imagePath]:
+            imageIDsByPath[imagePath].append(imageID)
+    return imageIDsByPath
+
+
+# Rename images with a few batched update service calls
+def renameImages(conn, imageNames):
+    imageIDs = list(imageNames.keys())
+    for i in range(0, len(imageIDs), omeroBatchSize):
+        params = ParametersI()
+        params.addIds(imageIDs[i : i + omeroBatchSize])
+        images = conn.getQueryService().findAllByQuery(
+            "select i from Image i where i.id in (:ids)", params, conn.SERVICE_OPTS
+        )
+        for image in images:
+            image.setName(rstring(imageNames[image.getId().val]))
+        conn.getUpdateService().saveArray(images, conn.SERVICE_OPTS)
+
+
+# Return a dictionary of name to id from a name/id projection query
+def getNameIndex(conn, query, params):
+    index = {}
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    for row in rows:
+        index[unwrap(row[0])] = unwrap(row[1])
+    return index
+
+
+# Return a dictionary of dataset name to dataset id for a project
+def getDatasetNameIndex(conn, projectID):
+    params = ParametersI()
+    params.addId(projectID)
+    query = (
+        "select d.name, d.id from ProjectDatasetLink l join l.child d"
+        " where l.parent.id = :id order by d.id"
+    )
+    return getNameIndex(conn, query, params)
 
 
-def mergeDictionaries(dict1, dict2):
-    dict = deepCopyDictionary(dict1)
-    mergedDict = deepMergeDictionaries(dict, dict2)
-    return mergedDict
+# Return a dictionary of image name to image id for a dataset
+def getImageNameIndex(conn, datasetID):
+    params = ParametersI()
+    params.addId(datasetID)
+    query = (
+        "select i.name, i.id from DatasetImageLink l join l.child i"
+        " where l.parent.id = :id order by i.id"
+    )
+    return getNameIndex(conn, query, params)
+
+
+# Return a dictionary of tag text to tag id for the tags of the group context,
+# the oldest tag is kept when several tags share a name
+def getTagIndex(conn):
+    query = "select t.textValue, t.id from TagAnnotation t order by t.id desc"
+    return getNameIndex(conn, query, ParametersI())
+
+
+# Create the tags missing from the tag index in a single call
+def createMissingTags(conn, tags, tagIndex):
+    missingTags = [tag for tag in tags if tag not in tagIndex]
+    if len(missingTags) == 0:
+        return
+    newTags = []
+    for tag in missingTags:
+        newTag = TagAnnotationI()
+        newTag.setTextValue(rstring(tag))
+        newTags.append(newTag)
+    savedTags = conn.getUpdateService().saveAndReturnArray(newTags, conn.SERVICE_OPTS)
+    for savedTag in savedTags:
+        tagIndex[savedTag.getTextValue().val] = savedTag.getId().val
+
+
+def getNamedValues(keyValueData):
+    return [NamedValue(str(kv[0]), str(kv[1])) for kv in keyValueData]
+
+
+# Return a new link between an object and an annotation
+def newAnnotationLink(objectType, objectID, annotation):
+    if objectType == "Project":
+        link = ProjectAnnotationLinkI()
+        link.setParent(ProjectI(objectID, False))
+    elif objectType == "Dataset":
+        link = DatasetAnnotationLinkI()
+        link.setParent(DatasetI(objectID, False))
+    else:
+        link = ImageAnnotationLinkI()
+        link.setParent(ImageI(objectID, False))
+    link.setChild(annotation)
+    return link
+
+
+# Return the image/annotation id pairs of the annotation links of the images
+# of a dataset
+def getImageAnnotationLinks(conn, datasetID):
+    params = ParametersI()
+    params.addId(datasetID)
+    query = (
+        "select l.parent.id, l.child.id from ImageAnnotationLink l"
+        " where l.parent.id in"
+        " (select d.child.id from DatasetImageLink d where d.parent.id = :id)"
+    )
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    return set((unwrap(row[0]), unwrap(row[1])) for row in rows)
+
+
+# Return the id of an image with a file of the given SHA-1 hash, by hash,
+# using the hashes Omero computed for the original files at import
+def getImageIDsByChecksum(conn, checksums):
+    imageIDsByChecksum = {}
+    checksums = list(checksums)
+    for i in range(0, len(checksums), omeroBatchSize):
+        params = ParametersI()
+        params.add(
+            "hashes",
+            rlist(
+                [rstring(checksum) for checksum in checksums[i : i + omeroBatchSize]]
+            ),
+        )
+        query = (
+            "select f.hash, i.id from Image i join i.fileset fs"
+            " join fs.usedFiles e join e.originalFile f"
+            " where f.hash in (:hashes) and f.hasher.value = 'SHA1-160'"
+            " order by i.id"
+        )
+        rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+        for row in rows:
+            checksum = unwrap(row[0])
+            if checksum not in imageIDsByChecksum:
+                imageIDsByChecksum[checksum] = unwrap(row[1])
+    return imageIDsByChecksum
+
+
+# Return the ids of the given images that still exist in Omero
+def getExistingImageIDs(conn, imageIDs):
+    existingImageIDs = set()
+    imageIDs = list(imageIDs)
+    for i in range(0, len(imageIDs), omeroBatchSize):
+        params = ParametersI()
+        params.addIds(imageIDs[i : i + omeroBatchSize])
+        query = "select i.id from Image i where i.id in (:ids)"
+        rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+        existingImageIDs.update(unwrap(row[0]) for row in rows)
+    return existingImageIDs
+
+
+# Split the files to import between the files to import and the files
+# identical to an image already imported or to a file earlier in the list,
+# the checksum of each file is set in its entry
+def findDuplicateImports(conn, pendingImports, checksumIndex, workers):
+    with ThreadPoolExecutor(max_workers=workers) as checksumExecutor:
+        checksumFutures = [
+            checksumExecutor.submit(
+                getFileChecksum, imageEntry["image"][metadata_image_path]
+            )
+            for imageEntry in pendingImports
+        ]
+    for imageEntry, future in zip(pendingImports, checksumFutures):
+        try:
+            imageEntry["checksum"] = future.result()
+        except (IOError, OSError) as e:
+            # left to the import to report
+            writeToLog(repr(e))
+    # images of the imported store deleted from Omero since are looked up by
+    # checksum again, the file is imported when no other image matches
+    knownChecksums = set(
+        imageEntry["checksum"]
+        for imageEntry in pendingImports
+        if "checksum" in imageEntry and imageEntry["checksum"] in checksumIndex
+    )
+    if len(knownChecksums) > 0:
+        existingImageIDs = getExistingImageIDs(
+            conn, set(checksumIndex[checksum] for checksum in knownChecksums)
+        )
+        for checksum in knownChecksums:
+            if checksumIndex[checksum] not in existingImageIDs:
+                del checksumIndex[checksum]
+    unknownChecksums = set(
+        imageEntry["checksum"]
+        for imageEntry in pendingImports
+        if "checksum" in imageEntry and imageEntry["checksum"] not in checksumIndex
+    )
+    if len(unknownChecksums) > 0:
+        checksumIndex.update(getImageIDsByChecksum(conn, unknownChecksums))
+    imports = []
+    duplicates = []
+    importChecksums = set()
+    for imageEntry in pendingImports:
+        checksum = imageEntry.get("checksum")
+        if checksum == None:
+            imports.append(imageEntry)
+        elif checksum in checksumIndex or checksum in importChecksums:
+            duplicates.append(imageEntry)
+        else:
+            importChecksums.add(checksum)
+            imports.append(imageEntry)
+    return imports, duplicates
+
+
+# Link existing images to a dataset, skipping those already in it
+def linkImagesToDataset(conn, datasetID, imageIDs):
+    params = ParametersI()
+    params.addId(datasetID)
+    query = "select l.child.id from DatasetImageLink l where l.parent.id = :id"
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    existingImageIDs = set(unwrap(row[0]) for row in rows)
+    links = []
+    for imageID in imageIDs:
+        if imageID in existingImageIDs:
+            continue
+        existingImageIDs.add(imageID)
+        link = DatasetImageLinkI()
+        link.setParent(DatasetI(datasetID, False))
+        link.setChild(ImageI(imageID, False))
+        links.append(link)
+    updateService = conn.getUpdateService()
+    for i in range(0, len(links), omeroBatchSize):
+        updateService.saveArray(links[i : i + omeroBatchSize], conn.SERVICE_OPTS)
+
+
+# Return the item sent through the transfer pipeline for an imported image
+def getTransferItem(imageEntry, projectName, target, destination, journal):
+    image = imageEntry["image"]
+    imageName = image[metadata_image_name]
+    imagePath = image[metadata_image_path]
+    transferItem = {
+        "path": imagePath,
+        "name": imageName,
+        "qname": imageEntry["qname"],
+        "project": projectName,
+        "record": imageEntry["current"],
+        "keys": imageEntry["keys"],
+        "journal": journal,
+    }
+    if destination != None:
+        imageCopyPath = imagePath.replace(target, destination)
+        transferItem["copyFolder"] = imageCopyPath.replace(imageName, "")
+    if "checksum" in imageEntry:
+        transferItem["checksum"] = imageEntry["checksum"]
+    if "previous" in imageEntry:
+        # transfers resumed from a previous run
+        transferItem["previous"] = True
+        transferItem[import_copied] = imageEntry["previous"].get(import_copied)
+        transferItem[import_uploaded] = imageEntry["previous"].get(import_uploaded)
+    return transferItem
+
+
+# Return if the transfers of a previously imported image were left
+# incomplete, its source is then queued again for them to resume
+def hasPendingTransfers(record, imagePath, destination, hasB2, hasDelete):
+    if not os.path.exists(imagePath):
+        return False
+    if destination != None and not record.get(import_copied, False):
+        return True
+    if hasB2 and not record.get(import_uploaded, False):
+        return True
+    # the source is left when the deletion failed
+    return hasDelete
+
+
+# Return the tags of an Image-list row
+def getImageTags(image):
+    if metadata_image_tags1 in image:
+        return image[metadata_image_tags1]
+    elif metadata_image_tags2 in image:
+        return image[metadata_image_tags2]
+    # TODO issue, raise
+    return []
+
+
+# Return the distinct tags used by all images of the collected metadata
+def collectImageTags(data):
+    tags = []
+    for projectKey in data:
+        datasets = data[projectKey][metadata_datasets]
+        for datasetKey in datasets:
+            for image in datasets[datasetKey][metadata_images]:
+                for tag in getImageTags(image):
+                    if tag not in tags:
+                        tags.append(tag)
+    return tags
 
 
 def deepCopyDictionary(dict1):
@@ -299,51 +1694,202 @@ def writeCurrentImported(dict):
         printToConsole(repr(e))
 
 
-def writePreviousImported(path, dict):
+def readPreviousImportedFile(path):
     importedFilePath = os.path.join(path, outputPreviousImportedFileName)
+    if not pathlib.Path(importedFilePath).resolve().exists():
+        return None
     try:
-        with open(importedFilePath, "w") as f:
+        with open(importedFilePath, "r") as f:
             try:
-                json.dump(dict, f)
+                data = json.load(f)
+                return data
             except (FileNotFoundError, PermissionError, OSError) as e:
-                message = (
-                    "Writing previous imported file failed for " + importedFilePath
-                )
+                message = "Reading previous imported failed for " + importedFilePath
                 writeToLog("ERROR: " + message)
                 writeToLog(repr(e))
                 printToConsole(message)
                 printToConsole(repr(e))
     except (IOError, OSError) as e:
-        message = "Writing previous imported file failed for " + importedFilePath
+        message = "Opening previous imported failed for " + importedFilePath
         writeToLog("ERROR: " + message)
         writeToLog(repr(e))
         printToConsole(message)
         printToConsole(repr(e))
 
 
-def readPreviousImportedFile(path):
+# Move the imported files of the previous imported file into the store, the
+# file is then renamed so that this happens once
+def migratePreviousImported(path, importedStore):
     importedFilePath = os.path.join(path, outputPreviousImportedFileName)
-    if not pathlib.Path(importedFilePath).resolve().exists():
+    data = readPreviousImportedFile(path)
+    if data == None:
+        return
+    for userFolder in data:
+        if isinstance(data[userFolder], dict):
+            importedStore.putUserData(userFolder, data[userFolder])
+    os.replace(importedFilePath, importedFilePath + ".migrated")
+    message = "Previous imported file migrated to " + importedStore.path
+    writeToLog(message)
+    printToConsole(message)
+
+
+def getJournalPath(path, userFolder):
+    return os.path.join(path, outputJournalFilePrefix + userFolder + ".txt")
+
+
+# Return the imported files of a user recorded in a journal, a last record
+# cut by a crash is ignored
+def readJournal(journalPath):
+    userData = {}
+    with open(journalPath, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            data = userData
+            for key in entry["keys"]:
+                if key not in data:
+                    data[key] = {}
+                data = data[key]
+            data.update(entry["record"])
+    return userData
+
+
+# Store the imported files recorded in the journal of a user and remove it
+def replayJournal(path, userFolder, importedStore):
+    journalPath = getJournalPath(path, userFolder)
+    if not os.path.exists(journalPath):
+        return
+    try:
+        importedStore.putUserData(userFolder, readJournal(journalPath))
+        os.remove(journalPath)
+    except (IOError, OSError, sqlite3.Error) as e:
+        message = "Replaying journal failed for " + journalPath
+        writeToLog("ERROR: " + message)
+        writeToLog(repr(e))
+        printToConsole(message)
+        printToConsole(repr(e))
+        return
+    message = "Journal replayed for " + userFolder
+    writeToLog(message)
+    printToConsole(message)
+
+
+# Replay the journals left by an interrupted run
+def replayJournals(path, importedStore):
+    for fileName in os.listdir(path):
+        if fileName.startswith(outputJournalFilePrefix) and fileName.endswith(".txt"):
+            userFolder = fileName[len(outputJournalFilePrefix) : -len(".txt")]
+            replayJournal(path, userFolder, importedStore)
+
+
+# The journal of a user is no longer needed once its imported files are
+# stored
+def clearJournal(path, userFolder):
+    journalPath = getJournalPath(path, userFolder)
+    if os.path.exists(journalPath):
+        os.remove(journalPath)
+
+
+def writeFingerprints(path, dict):
+    fingerprintsFilePath = os.path.join(path, outputFingerprintsFileName)
+    try:
+        with open(fingerprintsFilePath, "w") as f:
+            try:
+                json.dump(dict, f)
+            except (FileNotFoundError, PermissionError, OSError) as e:
+                message = "Writing fingerprints file failed for " + fingerprintsFilePath
+                writeToLog("ERROR: " + message)
+                writeToLog(repr(e))
+                printToConsole(message)
+                printToConsole(repr(e))
+    except (IOError, OSError) as e:
+        message = "Writing fingerprints file failed for " + fingerprintsFilePath
+        writeToLog("ERROR: " + message)
+        writeToLog(repr(e))
+        printToConsole(message)
+        printToConsole(repr(e))
+
+
+def readFingerprintsFile(path):
+    fingerprintsFilePath = os.path.join(path, outputFingerprintsFileName)
+    if not pathlib.Path(fingerprintsFilePath).resolve().exists():
         return None
     try:
-        with open(importedFilePath, "r") as f:
+        with open(fingerprintsFilePath, "r") as f:
             try:
                 data = json.load(f)
                 return data
-            except (FileNotFoundError, PermissionError, OSError) as e:
-                message = "Reading previous imported failed for " + importedFilePath
+            except (FileNotFoundError, PermissionError, OSError, ValueError) as e:
+                message = "Reading fingerprints failed for " + fingerprintsFilePath
                 writeToLog("ERROR: " + message)
                 writeToLog(repr(e))
                 printToConsole(message)
                 printToConsole(repr(e))
     except (IOError, OSError) as e:
-        message = "Opening previous imported failed for " + importedFilePath
+        message = "Opening fingerprints failed for " + fingerprintsFilePath
         writeToLog("ERROR: " + message)
         writeToLog(repr(e))
         printToConsole(message)
         printToConsole(repr(e))
 
 
+# Fingerprint of a project folder from the mtime of its directories and the
+# size and mtime of its files, None if the folder cannot be walked
+def getFolderFingerprint(folderPath):
+    fingerprint = hashlib.sha1()
+    try:
+        for dirPath, dirNames, fileNames in os.walk(folderPath):
+            dirNames.sort()
+            relDirPath = os.path.relpath(dirPath, folderPath)
+            dirStat = os.stat(dirPath)
+            fingerprint.update(
+                (relDirPath + "|" + str(dirStat.st_mtime_ns) + "\n").encode()
+            )
+            for fileName in sorted(fileNames):
+                fileStat = os.stat(os.path.join(dirPath, fileName))
+                fingerprint.update(
+                    (
+                        os.path.join(relDirPath, fileName)
+                        + "|"
+                        + str(fileStat.st_size)
+                        + "|"
+                        + str(fileStat.st_mtime_ns)
+                        + "\n"
+                    ).encode()
+                )
+    except OSError as e:
+        writeToLog("Fingerprint failed for " + str(folderPath))
+        writeToLog(repr(e))
+        return None
+    return fingerprint.hexdigest()
+
+
+# Return the fingerprint of a project folder and if the folder changed since
+# its last successful import
+def getProjectFolderChange(projectPath, userFingerprints):
+    fingerprint = getFolderFingerprint(projectPath)
+    isChanged = (
+        fingerprint == None
+        or userFingerprints == None
+        or userFingerprints.get(projectPath.name) != fingerprint
+    )
+    return fingerprint, isChanged
+
+
+# Return the project folders of a user changed since their last import
+def getChangedProjectPaths(userPath, userFingerprints):
+    projectPaths = []
+    for projectPath in userPath.iterdir():
+        if projectPath.is_file():
+            continue
+        fingerprint, isChanged = getProjectFolderChange(projectPath, userFingerprints)
+        if isChanged:
+            projectPaths.append(projectPath)
+    return projectPaths
+
+
 def initFiles(path):
     now = datetime.now()
     nowFormat = now.strftime(dateFormatter)
@@ -389,6 +1935,29 @@ def initFiles(path):
     #     writeToLog(repr(e) + "\n")
 
 
+# Set the log and imported file paths in a user folder worker process
+def initWorkerFiles(logFilePath, importedFilePath):
+    global outputLogFilePath
+    outputLogFilePath = logFilePath
+    global outputImportedFilePath
+    outputImportedFilePath = importedFilePath
+
+
+def isEndTimePassed(startTimeHr, startTimeMin, endTimeHr, endTimeMin):
+    if startTimeHr == None or startTimeMin == None:
+        return False
+    if endTimeHr == None or endTimeMin == None:
+        return False
+    now = datetime.now()
+    if now.hour < startTimeHr and now.hour > endTimeHr:
+        return True
+    if now.hour == endTimeHr and now.minute > endTimeMin:
+        return True
+    if now.hour == startTimeHr and now.minute < startTimeMin:
+        return True
+    return False
+
+
 def printToConsole(s):
     now = datetime.now()
     nowFormat = now.strftime(dateFormatter)
@@ -634,65 +2203,89 @@ def sendAdminEmail(emailTo, subject, text, emailFrom, emailFromPSW):
         server.sendmail(emailFrom, emailTo, email)
 
 
-def readCSVFile(path):
+# Parse the rows of a metadata CSV file, returns the image records of an
+# image list file or the Module/Key/Value data of a project or dataset file,
+# the module is optional and defaults to csv_module
+def parseCSVRows(rows):
+    dataArray = []
+    dataDict = {}
+    isImageListFile = False
+    keys = None
+    module = csv_module
+    for row in rows:
+        cells = [cell.strip() for cell in row]
+        if not any(cells):
+            continue
+        if cells[0].startswith(csv_section):
+            if cells[0].startswith(csv_imageSection):
+                isImageListFile = True
+            continue
+        if keys == None:
+            if metadata_image_name in cells:
+                isImageListFile = True
+                keys = cells
+                continue
+            if excel_key in cells and excel_value in cells:
+                keys = cells
+                continue
+            keys = [excel_key, excel_value]
+
+        if isImageListFile:
+            objectData = {}
+            for key, value in zip(keys, cells):
+                if key == metadata_image_tags1 or key == metadata_image_tags2:
+                    if value == "":
+                        value = []
+                    else:
+                        value = [tag.strip() for tag in value.split(csv_tagSeparator)]
+                if key == "" or value == "":
+                    continue
+                objectData[key] = value
+            if objectData != {}:
+                dataArray.append(objectData)
+        else:
+            rowData = dict(zip(keys, cells))
+            if rowData.get(excel_module, "") != "":
+                module = rowData[excel_module]
+            key = rowData.get(excel_key, "")
+            value = rowData.get(excel_value, "")
+            if key == "" or value == "":
+                continue
+            if module not in dataDict:
+                dataDict[module] = {}
+            dataDict[module][key] = value
+    if isImageListFile:
+        return dataArray
+    return dataDict
+
+
+# Read a metadata CSV file a row at a time, quoted fields may hold commas
+# and line breaks, the file must hold an image list only if isImageList
+def readCSVFile(path, isImageList):
     try:
-        with open(path) as f:
+        with open(path, newline="") as f:
             try:
-                dataArray = []
-                dataDict = {}
-                isImageListFile = False
-                keys = None
-                imageIndex = 0
-                while True:
-                    line = f.readline()
-                    if not line:
-                        break
-                    data = line.strip()
-                    if "- PROJECT" in data or "- DATASET" in data:
-                        continue
-                    if "- IMAGE" in data:
-                        isImageListFile = True
-                        continue
-                    if "Key,Value" in data:
-                        continue
-                    if "Image_Name" in data:
-                        keys = data.split(",")
-                        continue
-
-                    if not isImageListFile:
-                        dataSplit = data.split(",")
-                        key = dataSplit[0]
-                        value = dataSplit[1]
-                        dataDict[key] = value
-                    else:
-                        dataSplit = data.split(",")
-                        i = 0
-                        dataArray.append({})
-                        for key in keys:
-                            value = dataSplit[i]
-                            i = i + 1
-                            if (
-                                key == metadata_image_tags1
-                                or key == metadata_image_tags2
-                            ):
-                                if value == "":
-                                    tags = []
-                                else:
-                                    tags = value.split("#")
-                                dataArray[imageIndex][key] = tags
-                            else:
-                                dataArray[imageIndex][key] = value
-                        imageIndex = imageIndex + 1
-                f.close()
-                if isImageListFile:
-                    return dataArray
-                return dataDict
+                fileData = parseCSVRows(csv.reader(f))
             except Exception as e:
                 raise WrappedException("Read file failed for " + repr(path), e)
+    except WrappedException:
+        raise
     except Exception as e:
         raise WrappedException("Open file failed for " + repr(path), e)
+    if isImageList and fileData == {}:
+        # no rows
+        return []
+    if isImageList != isinstance(fileData, list):
+        if isImageList:
+            error = ValueError("An image list is expected")
+        else:
+            error = ValueError("Module, Key and Value rows are expected")
+        raise WrappedException("Read file failed for " + repr(path), error)
+    return fileData
 
 
+# Collect the metadata of a project folder from its CSV files, named
+# <project>.csv, <project>#<dataset>.csv and <project>#<dataset>#<list>.csv
 def collectMetadataFromCSV(path):
     data = {}
     projects = {}
@@ -703,45 +2296,33 @@ def collectMetadataFromCSV(path):
         if path.is_dir():
             continue
         name = path.name
-        if ".csv" not in name:
+        if not name.endswith(".csv"):
             continue
-        nameParts = name.split("#")
+        nameParts = name[: -len(".csv")].split("#")
         parts = len(nameParts)
         if parts == 1:
             # project
-            projectName = name.replace(".csv", "")
-            try:
-                projectData = readCSVFile(path)
-            except Exception as e:
-                raise
-            projects[projectName] = projectData
+            projects[nameParts[0]] = readCSVFile(path, False)
         elif parts == 2:
             # dataset
             projectName = nameParts[0]
-            datasetName = nameParts[1].replace(".csv", "")
-            try:
-                datasetData = readCSVFile(path)
-            except Exception as e:
-                raise
+            datasetName = nameParts[1]
             if projectName not in datasets:
                 datasets[projectName] = {}
-            datasets[projectName][datasetName] = datasetData
+            datasets[projectName][datasetName] = readCSVFile(path, False)
         elif parts == 3:
             # image list
             projectName = nameParts[0]
             datasetName = nameParts[1]
-            try:
-                imageData = readCSVFile(path)
-            except Exception as e:
-                raise
             if projectName not in images:
                 images[projectName] = {}
-            # images[projectName][datasetName] = []
-            images[projectName][datasetName] = imageData
+            images[projectName][datasetName] = readCSVFile(path, True)
 
     for projectKey in projects:
         data[projectKey] = projects[projectKey]
     for projectKey in datasets:
+        if projectKey not in data:
+            data[projectKey] = {}
         if metadata_datasets not in data[projectKey]:
             data[projectKey][metadata_datasets] = {}
         for datasetKey in datasets[projectKey]:
@@ -749,75 +2330,234 @@ def collectMetadataFromCSV(path):
                 datasetKey
             ]
     for projectKey in images:
+        if projectKey not in data:
+            data[projectKey] = {}
+        if metadata_datasets not in data[projectKey]:
+            data[projectKey][metadata_datasets] = {}
+        datasetsData = data[projectKey][metadata_datasets]
         for datasetKey in images[projectKey]:
-            if metadata_images not in data[projectKey][metadata_datasets][datasetKey]:
-                data[projectKey][metadata_datasets][datasetKey][metadata_images] = {}
-            data[projectKey][metadata_datasets][datasetKey][metadata_images] = images[
-                projectKey
-            ][datasetKey]
+            if datasetKey not in datasetsData:
+                datasetsData[datasetKey] = {}
+            datasetsData[datasetKey][metadata_images] = images[projectKey][datasetKey]
+    try:
+        completeMetadata(data)
+    except ValueError as e:
+        raise WrappedException("Read metadata failed for " + repr(str(targetPath)), e)
     printToConsole("Data:")
     printToConsole(str(data))
     return data
 
 
-def parseImageListSpreadsheetData(ssData):
-    data = []
-    keys = ssData.columns
-    size = len(ssData[keys[0]])
-    for i in range(0, size):
-        objectData = {}
-        for key in keys:
-            if key == excel_replaceNaN:
-                continue
-            value = ssData[key][i]
-            if key == metadata_image_tags1 or key == metadata_image_tags2:
-                if value == excel_replaceNaN:
-                    value = []
-                else:
-                    values = value.split(",")
-                    value = values
-            if value == excel_replaceNaN:
-                continue
-            if isinstance(value, str):
-                value = value.strip()
-            objectData[key] = value
-        if objectData != None and objectData != {}:
-            data.append(objectData)
-            # data[i] = objectData
+# Check the modules of a project or dataset hold key-value objects
+def checkMetadataModules(objectData, objectName, childrenKey):
+    for moduleKey in objectData:
+        if moduleKey == childrenKey:
+            continue
+        if not isinstance(objectData[moduleKey], dict):
+            raise ValueError(
+                "Module " + repr(moduleKey) + " of " + objectName + " is not an object"
+            )
+
+
+# Bring the metadata collected from CSV files or a JSON sidecar to the layout
+# of the Excel metadata, every project gets its datasets and every dataset its
+# images, raises ValueError when the layout cannot be used for the import
+def completeMetadata(data):
+    if not isinstance(data, dict):
+        raise ValueError("An object of projects is expected")
+    for projectKey in data:
+        project = data[projectKey]
+        projectName = "project " + repr(projectKey)
+        if not isinstance(project, dict):
+            raise ValueError(projectName + " is not an object")
+        checkMetadataModules(project, projectName, metadata_datasets)
+        if metadata_datasets not in project:
+            project[metadata_datasets] = {}
+        datasets = project[metadata_datasets]
+        if not isinstance(datasets, dict):
+            raise ValueError("Datasets of " + projectName + " are not an object")
+        for datasetKey in datasets:
+            dataset = datasets[datasetKey]
+            datasetName = "dataset " + repr(projectKey + "/" + datasetKey)
+            if not isinstance(dataset, dict):
+                raise ValueError(datasetName + " is not an object")
+            checkMetadataModules(dataset, datasetName, metadata_images)
+            if metadata_images not in dataset:
+                dataset[metadata_images] = []
+            images = dataset[metadata_images]
+            if not isinstance(images, list):
+                raise ValueError("Images of " + datasetName + " are not a list")
+            for image in images:
+                if not isinstance(image, dict):
+                    raise ValueError("An image of " + datasetName + " is not an object")
+                for key in [
+                    metadata_image_name,
+                    metadata_image_new_name,
+                    metadata_image_path,
+                ]:
+                    if not isinstance(image.get(key), str):
+                        raise ValueError(
+                            "An image of " + datasetName + " has no " + key
+                        )
+                if not isinstance(getImageTags(image), list):
+                    raise ValueError(
+                        "Tags of image "
+                        + repr(image[metadata_image_name])
+                        + " are not a list"
+                    )
     return data
 
 
-def parseSpreadsheetData(ssData, objectNameKey):
-    data = {}
-    objectData = {}
-    module = None
-    objectName = None
-    modules = ssData[excel_module].values
-    keys = ssData[excel_key].values
-    values = ssData[excel_value].values
-    for i in range(0, len(keys)):
-        if modules[i] != excel_replaceNaN:
-            module = modules[i]
-            if not module in objectData:
-                objectData[module] = {}
-        key = keys[i]
-        if key == excel_replaceNaN:
-            continue
-        value = values[i]
-        if value == excel_replaceNaN:
-            continue
-            # value = "NA"
-        if isinstance(value, str):
-            value = value.strip()
-        if key == objectNameKey:
+# Read the metadata of a project folder from its JSON sidecar, laid out as
+# the data collected from the Excel spreadsheets
+def collectMetadataFromJSON(path):
+    metadataPath = os.path.join(path, metadataFileName)
+    try:
+        with open(metadataPath, "r") as f:
+            data = json.load(f)
+    except Exception as e:
+        raise WrappedException("Read file failed for " + repr(metadataPath), e)
+    try:
+        completeMetadata(data)
+    except ValueError as e:
+        raise WrappedException("Read file failed for " + repr(metadataPath), e)
+    printToConsole("Data:")
+    printToConsole(str(data))
+    return data
+
+
+# Collect the metadata of a project folder from its JSON sidecar if any, else
+# from its Excel spreadsheets, else from its CSV files
+def collectMetadata(path, importedStore=None):
+    targetPath = pathlib.Path(path).resolve()
+    if targetPath.joinpath(metadataFileName).is_file():
+        return collectMetadataFromJSON(targetPath)
+    hasCSV = False
+    for filePath in targetPath.iterdir():
+        if filePath.is_dir():
+            continue
+        name = filePath.name
+        if ".xlsx" in name or ".xlsm" in name:
+            return collectMetadataFromExcel(targetPath, importedStore)
+        if name.endswith(".csv"):
+            hasCSV = True
+    if hasCSV:
+        return collectMetadataFromCSV(targetPath)
+    return {}
+
+
+# Collect the metadata of a project folder in a worker process, parsed
+# workbooks are cached in the imported store
+def collectMetadataInWorker(projectPath, importedStorePath):
+    importedStore = ImportedStore(importedStorePath)
+    try:
+        return collectMetadata(projectPath, importedStore)
+    finally:
+        importedStore.close()
+
+
+# Parse the image list a column at a time, empty cells are left out of the
+# image records and empty tags become an empty list
+def parseImageListSpreadsheetData(ssData):
+    data = []
+    keys = []
+    columns = []
+    for key in ssData.columns:
+        if key == excel_replaceNaN:
+            continue
+        column = ssData[key]
+        missing = column.isna() | (column == excel_replaceNaN)
+        if key == metadata_image_tags1 or key == metadata_image_tags2:
+            values = column.mask(missing, "").astype(str).str.split(",").tolist()
+            for i in missing.to_numpy().nonzero()[0]:
+                values[i] = []
+        else:
+            # only the string cells are stripped, object columns may hold
+            # times, booleans or numbers
+            cellTypes = pd.api.types.infer_dtype(column, skipna=True)
+            if cellTypes == "string":
+                stripped = column.str.strip()
+                column = stripped.where(stripped.notna(), column)
+            elif cellTypes.startswith("mixed"):
+                column = column.map(lambda v: v.strip() if isinstance(v, str) else v)
+            values = column.astype(object).where(~missing, None).tolist()
+        keys.append(key)
+        columns.append(values)
+    for row in zip(*columns):
+        objectData = {key: value for key, value in zip(keys, row) if value != None}
+        if objectData != {}:
+            data.append(objectData)
+    return data
+
+
+# Return a mask of the empty cells of a column of values
+def getEmptyCells(values):
+    return pd.isna(values) | (values == excel_replaceNaN)
+
+
+# Parse a Module/Key/Value sheet, the module of each row is forward filled
+# and rows with an empty key or value are left out
+def parseSpreadsheetData(ssData, objectNameKey):
+    data = {}
+    objectName = None
+    modules = ssData[excel_module].to_numpy(object)
+    keys = ssData[excel_key].to_numpy(object)
+    values = ssData[excel_value].to_numpy(object)
+    hasModule = ~getEmptyCells(modules)
+    # Index of the last row naming a module, -1 before the first one
+    moduleRows = np.maximum.accumulate(np.where(hasModule, np.arange(len(modules)), -1))
+    present = (moduleRows >= 0) & ~getEmptyCells(keys) & ~getEmptyCells(values)
+    # Modules keep the order in which they first appear in the sheet
+    objectData = dict.fromkeys(pd.unique(modules[hasModule]).tolist())
+    for module, key, value in zip(
+        modules[moduleRows[present]].tolist(),
+        keys[present].tolist(),
+        values[present].tolist(),
+    ):
+        if isinstance(value, str):
+            value = value.strip()
+        if key == objectNameKey:
             objectName = value
+        if objectData[module] == None:
+            objectData[module] = {}
         objectData[module][key] = value
-    cleanObjectData = {k: v for k, v in objectData.items() if v != None and v != {}}
+    cleanObjectData = {k: v for k, v in objectData.items() if v != None}
     data[objectName] = cleanObjectData
     return data
 
 
-def collectMetadataFromExcel(path):
+# Parse the project, dataset and image list sheets of a workbook opened once
+# with the read-only openpyxl reader
+def readExcelFile(path):
+    with pd.ExcelFile(path, engine="openpyxl") as excelFile:
+        ssFileProjectData = excelFile.parse(sheet_name=excel_project, header=8)
+        ssFileDatasetData = excelFile.parse(sheet_name=excel_dataset, header=8)
+        ssFileImageListData = excelFile.parse(sheet_name=excel_imageList, header=12)
+    ssProjectData = parseSpreadsheetData(ssFileProjectData, excel_projectName)
+    ssDatasetData = parseSpreadsheetData(ssFileDatasetData, excel_datasetName)
+    ssImageListData = parseImageListSpreadsheetData(ssFileImageListData)
+    return ssProjectData, ssDatasetData, ssImageListData
+
+
+# Parse a workbook unless the store has it cached unchanged
+def readExcelFileCached(path, importedStore):
+    if importedStore == None:
+        return readExcelFile(path)
+    stat = os.stat(path)
+    checksum = getFileChecksum(path)
+    cachePath = str(path)
+    ssData = importedStore.getSpreadsheet(
+        cachePath, stat.st_size, stat.st_mtime, checksum
+    )
+    if ssData == None:
+        ssData = readExcelFile(path)
+        importedStore.putSpreadsheet(
+            cachePath, stat.st_size, stat.st_mtime, checksum, ssData
+        )
+    return ssData
+
+
+def collectMetadataFromExcel(path, importedStore=None):
     data = {}
     targetPath = pathlib.Path(path).resolve()
     for path in targetPath.iterdir():
@@ -825,29 +2565,20 @@ def collectMetadataFromExcel(path):
             continue
         name = path.name
         if ".xlsx" in name or ".xlsm" in name:
-            ssFileProjectData = pd.read_excel(
-                path, sheet_name=excel_project, header=8
-            ).fillna(excel_replaceNaN)
-            ssProjectData = parseSpreadsheetData(ssFileProjectData, excel_projectName)
+            ssProjectData, ssDatasetData, ssImageListData = readExcelFileCached(
+                path, importedStore
+            )
             projectName = list(ssProjectData.keys())[0]
             if projectName not in data:
                 # TODO IF PROJECT NAME CHANGED IN SAME PROJECT DIRECTORY IF OVERRIDE OVERRIDE IF NOT SEND ERROR EMAIL
                 data.update(ssProjectData)
             if metadata_datasets not in data[projectName]:
                 data[projectName][metadata_datasets] = {}
-            ssFileDatasetData = pd.read_excel(
-                path, sheet_name=excel_dataset, header=8
-            ).fillna(excel_replaceNaN)
-            ssDatasetData = parseSpreadsheetData(ssFileDatasetData, excel_datasetName)
             datasetName = list(ssDatasetData.keys())[0]
             if datasetName not in data[projectName][metadata_datasets]:
                 data[projectName][metadata_datasets].update(ssDatasetData)
             if metadata_images not in data[projectName][metadata_datasets][datasetName]:
                 data[projectName][metadata_datasets][datasetName][metadata_images] = {}
-            ssFileImageListData = pd.read_excel(
-                path, sheet_name=excel_imageList, header=12
-            ).fillna(excel_replaceNaN)
-            ssImageListData = parseImageListSpreadsheetData(ssFileImageListData)
             data[projectName][metadata_datasets][datasetName][
                 metadata_images
             ] = ssImageListData
@@ -856,6 +2587,1173 @@ def collectMetadataFromExcel(path):
     return data
 
 
+# Import the projects of a single user folder, returns the imported data
+# of the user and if the end time has passed
+def importUserFolder(
+    userPath,
+    globalParams,
+    importedStorePath,
+    userFingerprints,
+    datasetNameIndexes,
+    imageNameIndexes,
+    projectNames=None,
+    prefetchPaths=None,
+    metadataExecutor=None,
+):
+    userName_g = globalParams[p_omeroUsername]
+    userPSW_g = globalParams[p_omeroPSW]
+    isAdmin = globalParams[p_isAdmin]
+    hostName = globalParams[p_omeroHostname]
+    portI = globalParams[p_omeroPort]
+    target = globalParams[p_target]
+    destination_g = globalParams[p_dest]
+    hasDelete_g = globalParams[p_delete]
+    hasDedupe = globalParams[p_dedupe]
+    hasMMA_g = globalParams[p_mma]
+    hasB2_g = globalParams[p_b2]
+    b2Endpoint_g = globalParams[p_b2_endpoint]
+    b2BucketName_g = globalParams[p_b2_bucketName]
+    b2AppKeyId_g = globalParams[p_b2_appKeyId]
+    b2AppKey_g = globalParams[p_b2_appKey]
+    adminsEmailTo = globalParams[p_adminsEmail]
+    emailFrom = globalParams[p_emailFrom]
+    emailFromPSW = globalParams[p_emailFromPSW]
+    startTimeHr, startTimeMin = globalParams[p_startTime]
+    endTimeHr, endTimeMin = globalParams[p_endTime]
+    importWorkersI = globalParams[p_importWorkers]
+    importChunkSizeI = globalParams[p_importChunkSize]
+    copyWorkersI = globalParams[p_copyWorkers]
+    b2ChunkSizeI = globalParams[p_b2_chunkSize]
+    b2PartWorkersI = globalParams[p_b2_partWorkers]
+    b2FileWorkersI = globalParams[p_b2_fileWorkers]
+
+    userFolder = userPath.name
+    userCurrentImportedData = {}
+    userCurrentFingerprints = {}
+    endTimePassed = False
+    userName = None
+    userPSW = None
+    emailTo = None
+    destination = None
+    hasDelete = None
+    hasMMA = None
+    hasB2 = None
+    b2Endpoint = None
+    b2BucketName = None
+    b2AppKeyId = None
+    b2AppKey = None
+    uParameters = readConfigFile(userPath)
+    # Read user parameters
+    # if uParameters == None:
+    #     error = (
+    #         "Reading user parameters from config file failed, user folder "
+    #         + userPath
+    #         + " skipped."
+    #     )
+    #     writeToLog("ERROR: " + error)
+    #     printToConsole("ERROR: " + error)
+    #     sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+    #     continue
+    if uParameters != None and uParameters != {}:
+        eKey = uParameters[p_key]
+        if eKey == None:
+            error = (
+                "Reading encryption key for user parameters failed, user folder "
+                + userPath
+                + " skipped."
+            )
+            writeToLog("ERROR: " + error)
+            printToConsole("ERROR: " + error)
+            sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+            return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+
+        f = Fernet(eKey)
+        for key in uParameters:
+            if key.startswith("#"):
+                continue
+            value = uParameters[key]
+            if key == p_omeroUsername:
+                userName = str(f.decrypt(value).decode())
+            if key == p_omeroPSW:
+                userPSW = str(f.decrypt(value).decode())
+            if key == p_userEmail:
+                emailTo = str(f.decrypt(value).decode())
+            if key == p_dest:
+                destination = value
+            if key == p_delete:
+                hasDelete = value
+            if key == p_mma:
+                hasMMA = value
+            if key == p_b2:
+                hasB2 = value
+            if key == p_b2_endpoint:
+                b2Endpoint = str(f.decrypt(value).decode())
+            if key == p_b2_bucketName:
+                b2BucketName = str(f.decrypt(value).decode())
+            if key == p_b2_appKeyId:
+                b2AppKeyId = str(f.decrypt(value).decode())
+            if key == p_b2_appKey:
+                b2AppKey = str(f.decrypt(value).decode())
+
+    if userName == None:
+        userName = userName_g
+    if userName == None:
+        error = (
+            "No Omero admin or user Username has not been specified, user folder "
+            + str(userPath)
+            + " skipped."
+        )
+        writeToLog("ERROR: " + error)
+        printToConsole("ERROR: " + error)
+        sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+        return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+
+    if userPSW == None:
+        userPSW = userPSW_g
+    if userPSW == None:
+        error = (
+            "No Omero admin or user Password has not been specified, user folder "
+            + str(userPath)
+            + " skipped."
+        )
+        writeToLog("ERROR: " + error)
+        printToConsole("ERROR: " + error)
+        sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+        return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+
+    # if emailTo == None:
+    #     error = (
+    #         "User email has not been specified, user folder "
+    #         + str(userPath)
+    #         + " skipped."
+    #     )
+    #     writeToLog("ERROR: " + error)
+    #     printToConsole("ERROR: " + error)
+    #     sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+    #     continue
+
+    if destination != None:
+        try:
+            destPath = pathlib.Path(destination).resolve()
+            if not destPath.exists():
+                error = (
+                    "User destination directory doesn't exists, user folder "
+                    + str(userPath)
+                    + " skipped."
+                )
+                writeToLog("ERROR: " + error)
+                printToConsole("ERROR: " + error)
+                sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+                return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+            if not destPath.is_dir():
+                error = (
+                    "User destination directory is not a directory, user folder "
+                    + str(userPath)
+                    + " skipped."
+                )
+                writeToLog("ERROR: " + error)
+                printToConsole("ERROR: " + error)
+                sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+                return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+            # destination = tmpDest
+        except IOError as e:
+            error = (
+                "Exception trying to determine if user destination directory exists and is a directory, user folder "
+                + str(userPath)
+                + " skipped."
+            )
+            writeToLog("ERROR: " + error)
+            writeToLog(repr(e))
+            printToConsole("ERROR: " + error)
+            printToConsole(repr(e))
+            sendErrorEmail(
+                emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW
+            )
+            return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+    else:
+        destination = destination_g
+
+    if hasDelete == None:
+        hasDelete = hasDelete_g
+
+    if hasMMA == None:
+        hasMMA = hasMMA_g
+
+    if hasB2 != None:
+        if hasB2 and (
+            (b2AppKeyId == None) or (b2AppKey == None) or (b2BucketName == None)
+        ):
+            error = (
+                "Some user bucket information for backblaze backup have not been specified, user folder "
+                + str(userPath)
+                + " skipped."
+            )
+            writeToLog("ERROR: " + error)
+            printToConsole("ERROR: " + error)
+            sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+            return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+    else:
+        hasB2 = hasB2_g
+        b2Endpoint = b2Endpoint_g
+        b2BucketName = b2BucketName_g
+        b2AppKeyId = b2AppKeyId_g
+        b2AppKey = b2AppKey_g
+
+    printToConsole("USER PARAMETERS CONFIG INIT")
+    printToConsole(str(uParameters))
+
+    # Project folders unchanged since their last successful import are
+    # skipped before any spreadsheet parsing or connection to Omero
+    projectPaths = []
+    projectFingerprints = {}
+    for projectPath in userPath.iterdir():
+        if projectPath.is_file():
+            continue
+        if projectNames != None and projectPath.name not in projectNames:
+            # not requested, its fingerprint is kept as it was
+            if userFingerprints != None and projectPath.name in userFingerprints:
+                userCurrentFingerprints[projectPath.name] = userFingerprints[
+                    projectPath.name
+                ]
+            continue
+        fingerprint, isChanged = getProjectFolderChange(projectPath, userFingerprints)
+        if not isChanged:
+            userCurrentFingerprints[projectPath.name] = fingerprint
+            writeToLog("Project folder unchanged, skipped " + str(projectPath))
+            continue
+        projectPaths.append(projectPath)
+        projectFingerprints[projectPath.name] = fingerprint
+    if len(projectPaths) == 0:
+        printToConsole("No changed project folders for " + userFolder)
+        return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+
+    # Call function to return reference to B2 service
+    b2 = None
+    if hasB2:
+        b2 = get_b2_resource(
+            b2Endpoint,
+            b2AppKeyId,
+            b2AppKey,
+            max(10, b2PartWorkersI * b2FileWorkersI),
+        )
+    # Call function to return reference to B2 service
+    # b2_client = get_b2_client(b2Endpoint, b2AppKeyId, b2AppKey)
+
+    # conn = BlitzGateway(
+    #     userName, userPSW, host=hostName, port=portI, secure=True
+    # )
+    # conn.connect()
+    conn = ezome.connect(
+        host=hostName,
+        port=portI,
+        user=userName,
+        password=userPSW,
+        group="",
+        secure=True,
+    )
+
+    if conn == None:
+        error = "Connection error, user folder " + str(userPath) + " skipped."
+        writeToLog("ERROR: " + error)
+        printToConsole("ERROR: " + error)
+        sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+        return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+    omeConnUser = conn.getUser()
+    omeConnUserName = omeConnUser.getName()
+    printToConsole("Connected")
+    printToConsole(str(conn))
+    conn.c.enableKeepAlive(60)
+    # conn.close(True)
+    # quit()
+
+    omeUserName = None
+    userConn = None
+    # userConn = None
+    if omeConnUserName.lower() != userFolder.lower() and isAdmin:
+        if conn.isFullAdmin():
+            omeUser = conn.getObject("Experimenter", attributes={"omeName": userFolder})
+            if omeUser == None:
+                error = (
+                    "Cannot find user "
+                    + userFolder
+                    + ", user folder "
+                    + str(userPath)
+                    + " skipped."
+                )
+                writeToLog("ERROR: " + error)
+                printToConsole("ERROR: " + error)
+                sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
+                conn.close()
+                return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+            omeUserName = omeUser.getName()
+            if emailTo == None:
+                emailTo = omeUser.getEmail()
+            # message = "Admin switched to user " + omeUser.getName()
+            # writeToLog(message)
+            # printToConsole(message)
+        else:
+            error = (
+                "Cannot find user "
+                + userFolder
+                + ", current connection doesn't have proper admin rights."
+            )
+            printToConsole(error)
+            writeToLog(error)
+            return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+
+    userSession = UserSession(conn, omeUserName)
+    importSessions = ImportSessions(
+        userSession,
+        lambda: ezome.connect(
+            host=hostName,
+            port=portI,
+            user=userName,
+            password=userPSW,
+            group="",
+            secure=True,
+        ),
+    )
+    userConn = userSession.get()
+    tagIndex = getTagIndex(userConn)
+    # Checksums of the files imported so far, to link identical files to
+    # their existing image instead of importing them again
+    importedStore = ImportedStore(importedStorePath)
+    # Records are journaled as they are made, for the next run to recover
+    # them if this one doesn't complete
+    journal = ImportJournal(getJournalPath(globalParams[p_localPath], userFolder))
+    checksumIndex = {}
+    if hasDedupe:
+        checksumIndex = importedStore.getChecksumIndex(userFolder)
+
+    # Imported files are copied, uploaded and deleted by the transfer
+    # pipeline while the following images are imported
+    transferPipeline = TransferPipeline(
+        (startTimeHr, startTimeMin, endTimeHr, endTimeMin)
+    )
+    if destination != None:
+        transferPipeline.addStage("Copy", copyStage, copyWorkersI)
+    if hasB2:
+        transferPipeline.addStage(
+            "Backblaze upload",
+            uploadStage,
+            b2FileWorkersI,
+            (b2BucketName, b2, b2ChunkSizeI, b2PartWorkersI),
+        )
+    if hasDelete:
+        transferPipeline.addStage("Delete", deleteStage, 1)
+    # Project folders are fingerprinted once their transfers are done
+    completedProjects = {}
+    # The metadata of the project folders is parsed by the metadata worker
+    # processes while the previous folders are imported, the folders of the
+    # next user are parsed too for their workbooks to be cached when it is
+    # imported, without the workers the metadata is parsed in the loop
+    metadataFutures = {}
+    prefetchFutures = []
+    if metadataExecutor != None:
+        for projectPath in projectPaths:
+            metadataFutures[projectPath.name] = metadataExecutor.submit(
+                collectMetadataInWorker, projectPath, importedStorePath
+            )
+        if prefetchPaths != None:
+            for projectPath in prefetchPaths:
+                prefetchFutures.append(
+                    metadataExecutor.submit(
+                        collectMetadataInWorker, projectPath, importedStorePath
+                    )
+                )
+
+    # find group_id using group name ?
+    # userConn.SERVICE_OPTS.setOmeroGroup(group_id)
+    # session = userConn.getSession()
+    # Explore User Projects
+    hasNewImport = False
+    for projectPath in projectPaths:
+        # projectCFolder = os.path.join(userFolder, projectPath.name)
+        userConn = userSession.get()
+        data = None
+        projectHasError = False
+        namespace = omero.constants.metadata.NSCLIENTMAPANNOTATION
+        annotationBatch = AnnotationBatch(namespace)
+        try:
+            if projectPath.name in metadataFutures:
+                data = metadataFutures.pop(projectPath.name).result()
+            else:
+                data = collectMetadata(projectPath, importedStore)
+        except WrappedException as e:
+            projectHasError = True
+            error = e.message
+            writeToLog(error)
+            writeToLog(repr(e.exception))
+            sendErrorEmail(
+                emailTo,
+                adminsEmailTo,
+                error + "\n" + repr(e.exception),
+                emailFrom,
+                emailFromPSW,
+            )
+        except Exception as e:
+            projectHasError = True
+            writeToLog(repr(e))
+            sendErrorEmail(
+                emailTo,
+                adminsEmailTo,
+                repr(e),
+                emailFrom,
+                emailFromPSW,
+            )
+        if data == None or data == {}:
+            continue
+        createMissingTags(userConn, collectImageTags(data), tagIndex)
+        for projectKey in data:
+            project = data[projectKey]
+            projectCurrentImportedData = None
+            projectFullImportedData = importedStore.getProject(userFolder, projectKey)
+            if projectKey not in userCurrentImportedData:
+                userCurrentImportedData[projectKey] = {}
+            projectCurrentImportedData = userCurrentImportedData[projectKey]
+            projectID = None
+            omeProject = None
+            projectQName = os.path.join(userFolder, projectKey)
+            projectCurrentImportedData[import_path] = projectQName
+            if projectFullImportedData == None:
+                omeProject = userConn.getObject(
+                    "Project", attributes={"name": projectKey}
+                )
+                if omeProject == None:
+                    newProject = ProjectWrapper(userConn, ProjectI())
+                    newProject.setName(projectKey)
+                    newProject.save()
+                    omeProject = newProject
+                    projectCurrentImportedData[import_status] = import_status_imported
+                    projectID = newProject._obj.id.val
+                    writeToLog(
+                        "Project created for "
+                        + projectQName
+                        + " ("
+                        + str(projectID)
+                        + ")"
+                    )
+                    hasNewImport = True
+                else:
+                    projectID = omeProject._obj.id.val
+                    projectCurrentImportedData[import_status] = import_status_found
+                    writeToLog(
+                        "Project found for "
+                        + projectQName
+                        + " ("
+                        + str(projectID)
+                        + ")"
+                    )
+            else:
+                projectID = projectFullImportedData[import_status_id]
+                omeProject = userConn.getObject("Project", projectID)
+                projectCurrentImportedData[import_status] = import_status_pimported
+                writeToLog(
+                    "Project previously imported for "
+                    + projectQName
+                    + " ("
+                    + str(projectID)
+                    + ")"
+                )
+
+            projectCurrentImportedData[import_status_id] = projectID
+            journal.append([([projectKey], projectCurrentImportedData)])
+
+            # TODO should we always update the annotation? or only if not previously imported?
+            # ATM only if not previously imported
+
+            projectKeyValueData = []
+            # projectKeyValueData = {}
+            # for projAnnKey in project:
+            #     if projAnnKey == metadata_datasets:
+            #         continue
+            #     projectKeyValueData.append([projAnnKey, project[projAnnKey]])
+            for moduleKey in project:
+                if moduleKey == metadata_datasets or moduleKey == excel_module_ome:
+                    continue
+                projectKeyValueData.append([moduleKey, ""])
+                for projAnnKey in project[moduleKey]:
+                    value = project[moduleKey][projAnnKey]
+                    dataSplit = None
+                    if "description" not in projAnnKey.lower() and isinstance(
+                        value, str
+                    ):
+                        dataSplit = value.split(",")
+                    if dataSplit != None and len(dataSplit) > 1:
+                        for i in range(0, len(dataSplit)):
+                            projectKeyValueData.append(
+                                [projAnnKey + "_" + str(i), str(dataSplit[i])]
+                            )
+                    else:
+                        projectKeyValueData.append([projAnnKey, str(value)])
+            if (
+                projectFullImportedData == None
+                or import_annotate not in projectFullImportedData
+                # or projectFullImportedData[import_annotate] == False
+            ):
+                if len(projectKeyValueData) > 0:
+                    annotationBatch.create(
+                        "Project",
+                        projectID,
+                        projectKeyValueData,
+                        projectCurrentImportedData,
+                        projectQName,
+                    )
+                    hasNewImport = True
+            elif projectFullImportedData.get(import_kvhash) != getKeyValueHash(
+                projectKeyValueData
+            ):
+                # only written again when the metadata changed
+                if len(projectKeyValueData) > 0:
+                    annotationBatch.update(
+                        "Project",
+                        projectID,
+                        projectFullImportedData[import_annotate],
+                        projectKeyValueData,
+                        projectCurrentImportedData,
+                        projectQName,
+                    )
+                else:
+                    # nothing to write, the empty list is recorded as written
+                    projectCurrentImportedData[import_kvhash] = getKeyValueHash(
+                        projectKeyValueData
+                    )
+                hasNewImport = True
+
+            for datasetKey in project[metadata_datasets]:
+                dataset = project[metadata_datasets][datasetKey]
+
+                userConn = userSession.get()
+
+                datasetFullImportedData = None
+                datasetCurrentImportedData = None
+                if projectFullImportedData != None:
+                    datasetFullImportedData = importedStore.getDataset(
+                        userFolder, projectKey, datasetKey
+                    )
+                imagesFullImportedData = {}
+                if datasetFullImportedData != None:
+                    imagesFullImportedData = importedStore.getImages(
+                        userFolder, projectKey, datasetKey
+                    )
+                if datasetKey not in projectCurrentImportedData:
+                    projectCurrentImportedData[datasetKey] = {}
+                datasetCurrentImportedData = projectCurrentImportedData[datasetKey]
+                datasetID = None
+                omeDataset = None
+                datasetQName = os.path.join(projectQName, datasetKey)
+                datasetCurrentImportedData[import_path] = datasetQName
+                if datasetFullImportedData == None:
+                    if projectID not in datasetNameIndexes:
+                        datasetNameIndexes[projectID] = getDatasetNameIndex(
+                            userConn, projectID
+                        )
+                    datasetNameIndex = datasetNameIndexes[projectID]
+                    omeDataset = None
+                    if datasetKey in datasetNameIndex:
+                        omeDataset = userConn.getObject(
+                            "Dataset", datasetNameIndex[datasetKey]
+                        )
+                    # omeDataset = userConn.getObject(
+                    #     "Dataset", attributes={"name": datasetKey}
+                    # )
+                    if omeDataset == None:
+                        newDataset = DatasetWrapper(userConn, DatasetI())
+                        newDataset.setName(datasetKey)
+                        newDataset.save()
+                        omeDataset = newDataset
+                        datasetID = newDataset._obj.id.val
+                        link = ProjectDatasetLinkI()
+                        link.setChild(DatasetI(datasetID, False))
+                        link.setParent(ProjectI(projectID, False))
+                        userConn.getUpdateService().saveObject(link)
+                        datasetNameIndex[datasetKey] = datasetID
+                        datasetCurrentImportedData[import_status] = (
+                            import_status_imported
+                        )
+                        writeToLog(
+                            "Dataset created for "
+                            + datasetQName
+                            + " ("
+                            + str(datasetID)
+                            + ")"
+                        )
+                        hasNewImport = True
+                    else:
+                        datasetID = omeDataset._obj.id.val
+                        datasetCurrentImportedData[import_status] = import_status_found
+                        writeToLog(
+                            "Dataset found for "
+                            + datasetQName
+                            + " ("
+                            + str(datasetID)
+                            + ")"
+                        )
+                else:
+                    datasetID = datasetFullImportedData[import_status_id]
+                    omeDataset = userConn.getObject("Dataset", datasetID)
+                    datasetCurrentImportedData[import_status] = import_status_pimported
+                    writeToLog(
+                        "Dataset previously imported for "
+                        + datasetQName
+                        + " ("
+                        + str(datasetID)
+                        + ")"
+                    )
+
+                datasetCurrentImportedData[import_status_id] = datasetID
+                journal.append([([projectKey, datasetKey], datasetCurrentImportedData)])
+
+                datasetKeyValueData = []
+                # for dsAnnKey in dataset:
+                #     if dsAnnKey == metadata_images:
+                #         continue
+                #     datasetKeyValueData.append([dsAnnKey, dataset[dsAnnKey]])
+                for moduleKey in dataset:
+                    if moduleKey == metadata_images or moduleKey == excel_module_ome:
+                        continue
+                    datasetKeyValueData.append([moduleKey, ""])
+                    for dsAnnKey in dataset[moduleKey]:
+                        value = dataset[moduleKey][dsAnnKey]
+                        dataSplit = None
+                        if "description" not in dsAnnKey.lower() and isinstance(
+                            value, str
+                        ):
+                            dataSplit = value.split(",")
+                        if dataSplit != None and len(dataSplit) > 1:
+                            for i in range(0, len(dataSplit)):
+                                datasetKeyValueData.append(
+                                    [dsAnnKey + "_" + str(i), str(dataSplit[i])]
+                                )
+                        else:
+                            datasetKeyValueData.append([dsAnnKey, str(value)])
+                if (
+                    datasetFullImportedData == None
+                    or import_annotate not in datasetFullImportedData
+                    # or datasetFullImportedData[import_annotate] == False
+                ):
+                    if len(datasetKeyValueData) > 0:
+                        annotationBatch.create(
+                            "Dataset",
+                            datasetID,
+                            datasetKeyValueData,
+                            datasetCurrentImportedData,
+                            datasetQName,
+                        )
+                        hasNewImport = True
+                elif datasetFullImportedData.get(import_kvhash) != getKeyValueHash(
+                    datasetKeyValueData
+                ):
+                    if len(datasetKeyValueData) > 0:
+                        annotationBatch.update(
+                            "Dataset",
+                            datasetID,
+                            datasetFullImportedData[import_annotate],
+                            datasetKeyValueData,
+                            datasetCurrentImportedData,
+                            datasetQName,
+                        )
+                    else:
+                        # nothing to write, the empty list is recorded as written
+                        datasetCurrentImportedData[import_kvhash] = getKeyValueHash(
+                            datasetKeyValueData
+                        )
+                    hasNewImport = True
+
+                imageEntries = []
+                pendingImports = []
+                for image in dataset[metadata_images]:
+                    printToConsole("image metadata")
+                    printToConsole(str(image))
+
+                    imageName = image[metadata_image_name]
+                    imageNewName = image[metadata_image_new_name]
+                    imagePath = image[metadata_image_path]
+                    # imageFolderPath = image["Image_Path"]
+                    # imagePath = os.path.join(imageFolderPath, imageName)
+
+                    imageFullImportedData = imagesFullImportedData.get(imageName)
+                    imageID = None
+                    omeImage = None
+                    imageQName = imagePath.replace(target, "")[1:]
+                    # imageQName = os.path.join(datasetQName, relImagePath)
+                    imageEntry = {
+                        "image": image,
+                        "qname": imageQName,
+                        "full": imageFullImportedData,
+                        "keys": [projectKey, datasetKey, imageName],
+                    }
+                    if imageFullImportedData == None:
+                        if datasetID not in imageNameIndexes:
+                            imageNameIndexes[datasetID] = getImageNameIndex(
+                                userConn, datasetID
+                            )
+                        imageNameIndex = imageNameIndexes[datasetID]
+                        omeImage = None
+                        if imageNewName in imageNameIndex:
+                            omeImage = userConn.getObject(
+                                "Image", imageNameIndex[imageNewName]
+                            )
+                        # omeImage = userConn.getObject(
+                        #     "Image", attributes={"name": imageNewName}
+                        # )
+                        if omeImage == None:
+                            pendingImports.append(imageEntry)
+                            continue
+                        imageID = omeImage._obj.id.val
+                        imageStatus = import_status_found
+                        writeToLog(
+                            "Image found for " + imageQName + " (" + str(imageID) + ")"
+                        )
+                    else:
+                        imageID = imageFullImportedData[import_status_id]
+                        omeImage = userConn.getObject("Image", imageID)
+                        imageID = omeImage._obj.id.val
+                        imageStatus = import_status_pimported
+                        writeToLog(
+                            "Image previously imported for "
+                            + imageQName
+                            + " ("
+                            + str(imageID)
+                            + ")"
+                        )
+
+                    if imageName not in datasetCurrentImportedData:
+                        datasetCurrentImportedData[imageName] = {}
+                    imageCurrentImportedData = datasetCurrentImportedData[imageName]
+                    imageCurrentImportedData[import_path] = imageQName
+                    imageCurrentImportedData[import_status] = imageStatus
+                    imageCurrentImportedData[import_status_id] = imageID
+                    imageEntry["current"] = imageCurrentImportedData
+                    imageEntries.append(imageEntry)
+                    if imageStatus == import_status_pimported and hasPendingTransfers(
+                        imageFullImportedData, imagePath, destination, hasB2, hasDelete
+                    ):
+                        imageEntry["previous"] = imageFullImportedData
+                        if import_checksum in imageFullImportedData:
+                            imageEntry["checksum"] = imageFullImportedData[
+                                import_checksum
+                            ]
+                        writeToLog("Image transfers resumed for " + imageQName)
+                        transferPipeline.put(
+                            getTransferItem(
+                                imageEntry,
+                                projectPath.name,
+                                target,
+                                destination,
+                                journal,
+                            )
+                        )
+                journal.append(
+                    [
+                        (imageEntry["keys"], imageEntry["current"])
+                        for imageEntry in imageEntries
+                    ]
+                )
+
+                duplicateImports = []
+                if hasDedupe and len(pendingImports) > 0:
+                    pendingImports, duplicateImports = findDuplicateImports(
+                        userConn, pendingImports, checksumIndex, importWorkersI
+                    )
+
+                # Import new images with a pool of workers, the results
+                # are handled here as each import completes
+                # with -mf several files are handed to each import invocation
+                importChunks = []
+                for i in range(0, len(pendingImports), importChunkSizeI):
+                    importChunks.append(pendingImports[i : i + importChunkSizeI])
+                importExecutor = ThreadPoolExecutor(max_workers=importWorkersI)
+                importFutures = {}
+                importIndex = 0
+                pendingRenames = {}
+                while True:
+                    if isEndTimePassed(
+                        startTimeHr, startTimeMin, endTimeHr, endTimeMin
+                    ):
+                        endTimePassed = True
+                    while (
+                        not endTimePassed
+                        and importIndex < len(importChunks)
+                        and len(importFutures) < importWorkersI
+                    ):
+                        importChunk = importChunks[importIndex]
+                        importIndex = importIndex + 1
+                        imagePaths = [
+                            imageEntry["image"][metadata_image_path]
+                            for imageEntry in importChunk
+                        ]
+                        if importChunkSizeI > 1:
+                            future = importExecutor.submit(
+                                importSessions.run,
+                                importImageFiles,
+                                imagePaths,
+                                datasetID,
+                            )
+                        else:
+                            future = importExecutor.submit(
+                                importSessions.run,
+                                importImageFile,
+                                imagePaths[0],
+                                projectID,
+                                datasetID,
+                                importChunk[0]["image"][metadata_image_new_name],
+                            )
+                        importFutures[future] = importChunk
+                    if len(importFutures) == 0:
+                        break
+                    doneFutures, notDoneFutures = wait(
+                        importFutures, return_when=FIRST_COMPLETED
+                    )
+                    for future in doneFutures:
+                        importChunk = importFutures.pop(future)
+                        journalEntries = []
+                        importError = ""
+                        try:
+                            importedImageIDs = future.result()
+                        except Exception as e:
+                            importedImageIDs = {}
+                            importError = repr(e)
+                        for imageEntry in importChunk:
+                            image = imageEntry["image"]
+                            imageName = image[metadata_image_name]
+                            imageNewName = image[metadata_image_new_name]
+                            imagePath = image[metadata_image_path]
+                            imageQName = imageEntry["qname"]
+                            imageIDs = importedImageIDs.get(imagePath)
+                            if imageIDs == None or len(imageIDs) == 0:
+                                projectHasError = True
+                                error = "Import failed for " + imageQName
+                                writeToLog("ERROR: " + error)
+                                writeToLog(importError)
+                                printToConsole("ERROR: " + error)
+                                printToConsole(importError)
+                                sendErrorEmail(
+                                    emailTo,
+                                    adminsEmailTo,
+                                    error + importError,
+                                    emailFrom,
+                                    emailFromPSW,
+                                )
+                                continue
+                            imageID = imageIDs[0]
+                            if importChunkSizeI > 1:
+                                # images imported together are renamed in bulk
+                                pendingRenames[imageID] = imageNewName
+                            imageNameIndexes[datasetID][imageNewName] = imageID
+                            if imageName not in datasetCurrentImportedData:
+                                datasetCurrentImportedData[imageName] = {}
+                            imageCurrentImportedData = datasetCurrentImportedData[
+                                imageName
+                            ]
+                            imageCurrentImportedData[import_path] = imageQName
+                            imageCurrentImportedData[import_status] = (
+                                import_status_imported
+                            )
+                            imageCurrentImportedData[import_status_id] = imageID
+                            if "checksum" in imageEntry:
+                                checksumIndex[imageEntry["checksum"]] = imageID
+                                imageCurrentImportedData[import_checksum] = imageEntry[
+                                    "checksum"
+                                ]
+                            imageEntry["current"] = imageCurrentImportedData
+                            imageEntries.append(imageEntry)
+                            writeToLog(
+                                "Image imported for "
+                                + imageQName
+                                + " ("
+                                + str(imageID)
+                                + ")"
+                            )
+                            hasNewImport = True
+                            journalEntries.append(
+                                (imageEntry["keys"], imageCurrentImportedData)
+                            )
+                            transferPipeline.put(
+                                getTransferItem(
+                                    imageEntry,
+                                    projectPath.name,
+                                    target,
+                                    destination,
+                                    journal,
+                                )
+                            )
+                        journal.append(journalEntries)
+                importExecutor.shutdown()
+                renameImages(userConn, pendingRenames)
+
+                # Files identical to an imported image are linked to it
+                duplicateImageIDs = []
+                for imageEntry in duplicateImports:
+                    image = imageEntry["image"]
+                    imageName = image[metadata_image_name]
+                    imageQName = imageEntry["qname"]
+                    imageID = checksumIndex.get(imageEntry["checksum"])
+                    if imageID == None:
+                        # the identical file was not imported
+                        if endTimePassed:
+                            continue
+                        projectHasError = True
+                        error = "Import failed for " + imageQName
+                        writeToLog("ERROR: " + error)
+                        printToConsole("ERROR: " + error)
+                        sendErrorEmail(
+                            emailTo, adminsEmailTo, error, emailFrom, emailFromPSW
+                        )
+                        continue
+                    if imageName not in datasetCurrentImportedData:
+                        datasetCurrentImportedData[imageName] = {}
+                    imageCurrentImportedData = datasetCurrentImportedData[imageName]
+                    imageCurrentImportedData[import_path] = imageQName
+                    imageCurrentImportedData[import_status] = import_status_duplicate
+                    imageCurrentImportedData[import_status_id] = imageID
+                    imageCurrentImportedData[import_checksum] = imageEntry["checksum"]
+                    imageEntry["current"] = imageCurrentImportedData
+                    imageEntries.append(imageEntry)
+                    duplicateImageIDs.append(imageID)
+                    writeToLog(
+                        "Image duplicate found for "
+                        + imageQName
+                        + " ("
+                        + str(imageID)
+                        + ")"
+                    )
+                    hasNewImport = True
+                    transferPipeline.put(
+                        getTransferItem(
+                            imageEntry, projectPath.name, target, destination, journal
+                        )
+                    )
+                if len(duplicateImageIDs) > 0:
+                    linkImagesToDataset(userConn, datasetID, duplicateImageIDs)
+                    journal.append(
+                        [
+                            (imageEntry["keys"], imageEntry["current"])
+                            for imageEntry in duplicateImports
+                            if "current" in imageEntry
+                        ]
+                    )
+
+                for imageEntry in imageEntries:
+                    image = imageEntry["image"]
+                    imageTags = getImageTags(image)
+                    imageQName = imageEntry["qname"]
+                    imageFullImportedData = imageEntry["full"]
+                    imageCurrentImportedData = imageEntry["current"]
+                    imageID = imageCurrentImportedData[import_status_id]
+
+                    imageKeyValueData = []
+                    for imgAnnKey in image:
+                        if (
+                            imgAnnKey == metadata_image_new_name
+                            or imgAnnKey == metadata_image_path
+                            or imgAnnKey == metadata_image_mma
+                            or imgAnnKey == metadata_image_tags1
+                            or imgAnnKey == metadata_image_tags2
+                        ):
+                            continue
+                        imageKeyValueData.append([imgAnnKey, str(image[imgAnnKey])])
+                    imageKeyValueHash = getKeyValueHash(imageKeyValueData)
+                    if (
+                        imageFullImportedData != None
+                        and imageFullImportedData.get(import_kvhash)
+                        == imageKeyValueHash
+                    ):
+                        # metadata unchanged since it was last written
+                        continue
+                    if (
+                        imageFullImportedData == None
+                        or import_annotate not in imageFullImportedData
+                        # or imageFullImportedData[import_annotate] == False
+                    ):
+                        if len(imageKeyValueData) > 0:
+                            annotationBatch.create(
+                                "Image",
+                                imageID,
+                                imageKeyValueData,
+                                imageCurrentImportedData,
+                                imageQName,
+                            )
+                        else:
+                            imageCurrentImportedData[import_annotate] = None
+                            imageCurrentImportedData[import_kvhash] = imageKeyValueHash
+                        if len(imageTags) > 0:
+                            annotationBatch.linkTags(
+                                imageID,
+                                [tagIndex[imgTag] for imgTag in imageTags],
+                                imageQName,
+                            )
+                        hasNewImport = True
+                    else:
+                        if len(imageKeyValueData) > 0:
+                            annotationBatch.update(
+                                "Image",
+                                imageID,
+                                imageFullImportedData[import_annotate],
+                                imageKeyValueData,
+                                imageCurrentImportedData,
+                                imageQName,
+                            )
+                        else:
+                            # nothing to write, the empty list is recorded as written
+                            imageCurrentImportedData[import_kvhash] = getKeyValueHash(
+                                imageKeyValueData
+                            )
+                        hasNewImport = True
+
+                annotationBatch.flush(userConn, datasetID)
+                journalEntries = [
+                    ([projectKey, datasetKey], datasetCurrentImportedData)
+                ]
+                for imageEntry in imageEntries:
+                    journalEntries.append((imageEntry["keys"], imageEntry["current"]))
+                journal.append(journalEntries)
+
+                if endTimePassed:
+                    break
+            annotationBatch.flush(userConn)
+            journal.append([([projectKey], projectCurrentImportedData)])
+            if endTimePassed:
+                break
+        if endTimePassed:
+            break
+        if not projectHasError:
+            completedProjects[projectPath.name] = projectPath
+
+    for transfer, transferItem, transferError in transferPipeline.close():
+        error = transfer + " failed for " + transferItem["qname"]
+        printToConsole("ERROR: " + error)
+        printToConsole(transferError)
+        sendErrorEmail(
+            emailTo, adminsEmailTo, error + transferError, emailFrom, emailFromPSW
+        )
+        completedProjects.pop(transferItem["project"], None)
+    for transfer, transferItem in transferPipeline.pending:
+        # the project folder is scanned again by the next run, which resumes
+        # the transfers of its previously imported images
+        writeToLog(transfer + " left for the next run for " + transferItem["qname"])
+        completedProjects.pop(transferItem["project"], None)
+        endTimePassed = True
+    if endTimePassed:
+        for future in list(metadataFutures.values()) + prefetchFutures:
+            future.cancel()
+    else:
+        # the next user finds the workbooks parsed ahead cached
+        wait(prefetchFutures)
+    for projectName in completedProjects:
+        # the fingerprint taken before the import is kept, files arriving
+        # during the import must not be taken as imported, files removed by
+        # -del cause one more scan of the folder
+        fingerprint = projectFingerprints[projectName]
+        if fingerprint != None:
+            userCurrentFingerprints[projectName] = fingerprint
+
+    sendCompleteEmail(
+        emailTo,
+        adminsEmailTo,
+        hasNewImport,
+        userCurrentImportedData,
+        emailFrom,
+        emailFromPSW,
+    )
+
+    journal.close()
+    importedStore.close()
+    importSessions.close()
+    userSession.close()
+    conn.close()
+    printToConsole("Close connection")
+    return userCurrentImportedData, userCurrentFingerprints, endTimePassed
+
+
+# Write the imported files of this run and the fingerprints
+def writeImportedData(localPath, currentImportedData, fingerprints):
+    writeCurrentImported(currentImportedData)
+    writeFingerprints(localPath, fingerprints)
+
+
+# Watch the target directory and import the project folders that changed
+# once none of their files changed for watchStableSeconds
+def watchTarget(
+    targetPath,
+    localPath,
+    globalParams,
+    importedStore,
+    currentImportedData,
+    fingerprints,
+    metadataExecutor,
+):
+    startTimeHr, startTimeMin = globalParams[p_startTime]
+    endTimeHr, endTimeMin = globalParams[p_endTime]
+    watcher = None
+    if not isNetworkFileSystem(targetPath):
+        try:
+            watcher = InotifyWatcher(targetPath)
+        except (OSError, AttributeError, TypeError) as e:
+            writeToLog("Inotify not available, polling the target directory")
+            writeToLog(repr(e))
+    if watcher == None:
+        watcher = PollingWatcher(targetPath)
+    message = "Watching " + str(targetPath) + " with " + type(watcher).__name__
+    writeToLog(message)
+    printToConsole(message)
+
+    # changed project folders with their last fingerprint and change time
+    pendingProjects = {}
+    while True:
+        for projectPath in watcher.poll(watchCheckSeconds):
+            pendingProjects[projectPath] = (None, time.time())
+        if isEndTimePassed(startTimeHr, startTimeMin, endTimeHr, endTimeMin):
+            continue
+        readyProjects = {}
+        for projectPath in list(pendingProjects):
+            fingerprint, changeTime = pendingProjects[projectPath]
+            if not projectPath.is_dir():
+                del pendingProjects[projectPath]
+                continue
+            currentFingerprint = getFolderFingerprint(projectPath)
+            if currentFingerprint == None or currentFingerprint != fingerprint:
+                pendingProjects[projectPath] = (currentFingerprint, time.time())
+                continue
+            if time.time() - changeTime < watchStableSeconds:
+                continue
+            del pendingProjects[projectPath]
+            userFolder = projectPath.parent.name
+            if userFolder not in readyProjects:
+                readyProjects[userFolder] = []
+            readyProjects[userFolder].append(projectPath.name)
+        if len(readyProjects) == 0:
+            continue
+
+        for userFolder in readyProjects:
+            (
+                userCurrentImportedData,
+                userCurrentFingerprints,
+                endTimePassed,
+            ) = importUserFolder(
+                targetPath / userFolder,
+                globalParams,
+                importedStore.path,
+                fingerprints.get(userFolder),
+                {},
+                {},
+                readyProjects[userFolder],
+                None,
+                metadataExecutor,
+            )
+            if userFolder not in currentImportedData:
+                currentImportedData[userFolder] = {}
+            deepMergeDictionaries(
+                currentImportedData[userFolder], userCurrentImportedData
+            )
+            importedStore.putUserData(userFolder, userCurrentImportedData)
+            clearJournal(localPath, userFolder)
+            fingerprints[userFolder] = userCurrentFingerprints
+            if endTimePassed:
+                break
+        writeImportedData(localPath, currentImportedData, fingerprints)
+
+
 def main(argv, argc):
     if len(argv) > 1 and argv[1] == "-h":
         print("Help for Omero Importer CL")
@@ -871,15 +3769,40 @@ def main(argv, argc):
         )
         print("-del, to delete files after import and copy, default is false")
         print("-mma, to add microscope and acquisition settings file, default is false")
+        print(
+            "-dd, to link files identical to an already imported image instead of importing them again, default is false"
+        )
         print(
             "-b2 <endpoint#bucketName#appKeyId#appKey>, to use backblaze as destination for copy (conflict with -d)"
         )
+        print(
+            "-b2opt <chunkMB#partConcurrency#fileWorkers>, size in MB of the backblaze upload parts (min 5), parts uploaded concurrently per file and files uploaded concurrently, default is 100#4#1"
+        )
         print(
             "-ts <hh:mm>, to specify the daily start time of the application, default is non-stop"
         )
         print(
             "-te <hh:mm>, to specify the time limit after which the application should auto terminate, default is non-stop"
         )
+        print("-j <number>, number of images imported concurrently, default is 1")
+        print(
+            "-uj <number>, number of user folders imported concurrently in separate processes, default is 1"
+        )
+        print(
+            "-mf <number>, number of files of a dataset handed to a single import invocation, default is 1"
+        )
+        print(
+            "-cw <number>, number of files copied concurrently to the destination, default is 1"
+        )
+        print(
+            "-mw <number>, number of processes parsing project metadata ahead of the import, default is 1"
+        )
+        print(
+            "--watch, to keep running after the import and import the project folders as they change"
+        )
+        print(
+            "-rs, to rescan all project folders, ignoring the fingerprints of folders unchanged since the last import"
+        )
         print("*-sml <email address> to set up automatic email sender")
         print("*-smlp <password> to set up automatic email sender password")
         print(
@@ -919,6 +3842,7 @@ def main(argv, argc):
     # Both param
     destination_g = None
     hasDelete_g = False
+    hasDedupe_g = False
     hasMMA_g = False
     hasB2_g = False
     b2Endpoint_g = None
@@ -937,6 +3861,16 @@ def main(argv, argc):
     adminsEmailTo = None
     emailFrom = None
     emailFromPSW = None
+    importWorkers = 1
+    userWorkers = 1
+    importChunkSize = 1
+    copyWorkers = 1
+    metadataWorkers = 1
+    b2ChunkSize = 100
+    b2PartWorkers = 4
+    b2FileWorkers = 1
+    rescan = False
+    watch = False
 
     # User param
     userDirectoryPath = None
@@ -1003,6 +3937,8 @@ def main(argv, argc):
             destination_g = argv[i + 1]
         elif arg == "-del":
             hasDelete_g = True
+        elif arg == "-dd":
+            hasDedupe_g = True
         elif arg == "-mma":
             hasMMA_g = True
         elif arg == "-b2":
@@ -1020,6 +3956,17 @@ def main(argv, argc):
             b2BucketName_g = b2DataSplit[1]
             b2AppKeyId_g = b2DataSplit[2]
             b2AppKey_g = b2DataSplit[3]
+        elif arg == "-b2opt":
+            b2OptData = argv[i + 1]
+            b2OptDataSplit = b2OptData.split("#")
+            if len(b2OptDataSplit) != 3:
+                error = "wrong number of arguments in -b2opt option, application terminated."
+                writeToLog("ERROR: " + error)
+                printToConsole("ERROR: " + error)
+                quit()
+            b2ChunkSize = b2OptDataSplit[0]
+            b2PartWorkers = b2OptDataSplit[1]
+            b2FileWorkers = b2OptDataSplit[2]
         elif arg == "-ml":
             mlData = argv[i + 1]
             mlDataSplit = mlData.split(":")
@@ -1036,6 +3983,20 @@ def main(argv, argc):
             emailFrom = argv[i + 1]
         elif arg == "-smlp":
             emailFromPSW = argv[i + 1]
+        elif arg == "-j":
+            importWorkers = argv[i + 1]
+        elif arg == "-uj":
+            userWorkers = argv[i + 1]
+        elif arg == "-mf":
+            importChunkSize = argv[i + 1]
+        elif arg == "-cw":
+            copyWorkers = argv[i + 1]
+        elif arg == "-mw":
+            metadataWorkers = argv[i + 1]
+        elif arg == "-rs":
+            rescan = True
+        elif arg == "--watch":
+            watch = True
         elif arg == "-ts":
             teData = argv[i + 1]
             teDataSplit = teData.split(":")
@@ -1084,6 +4045,8 @@ def main(argv, argc):
             dict[p_dest] = destination_g
         if hasDelete_g:
             dict[p_delete] = hasDelete_g
+        if hasDedupe_g:
+            dict[p_dedupe] = hasDedupe_g
         if hasMMA_g:
             dict[p_mma] = hasMMA_g
         if hasB2_g:
@@ -1098,6 +4061,14 @@ def main(argv, argc):
             dict[p_startTime] = str(startTimeHr) + ":" + str(startTimeMin)
         if endTimeHr != None and endTimeMin != None:
             dict[p_endTime] = str(endTimeHr) + ":" + str(endTimeMin)
+        dict[p_importWorkers] = importWorkers
+        dict[p_userWorkers] = userWorkers
+        dict[p_importChunkSize] = importChunkSize
+        dict[p_copyWorkers] = copyWorkers
+        dict[p_metadataWorkers] = metadataWorkers
+        dict[p_b2_chunkSize] = b2ChunkSize
+        dict[p_b2_partWorkers] = b2PartWorkers
+        dict[p_b2_fileWorkers] = b2FileWorkers
         dict[p_adminsEmail] = adminsEmailTo
         dict[p_emailFrom] = f.encrypt(bytes(emailFrom, "utf8")).decode()
         dict[p_emailFromPSW] = f.encrypt(bytes(emailFromPSW, "utf8")).decode()
@@ -1167,6 +4138,8 @@ def main(argv, argc):
             destination_g = value
         if key == p_delete:
             hasDelete_g = value
+        if key == p_dedupe:
+            hasDedupe_g = value
         if key == p_mma:
             hasMMA_g = value
         if key == p_b2:
@@ -1185,6 +4158,22 @@ def main(argv, argc):
             emailFrom = str(f.decrypt(value).decode())
         if key == p_emailFromPSW:
             emailFromPSW = str(f.decrypt(value).decode())
+        if key == p_importWorkers:
+            importWorkers = value
+        if key == p_userWorkers:
+            userWorkers = value
+        if key == p_importChunkSize:
+            importChunkSize = value
+        if key == p_copyWorkers:
+            copyWorkers = value
+        if key == p_metadataWorkers:
+            metadataWorkers = value
+        if key == p_b2_chunkSize:
+            b2ChunkSize = value
+        if key == p_b2_partWorkers:
+            b2PartWorkers = value
+        if key == p_b2_fileWorkers:
+            b2FileWorkers = value
         if key == p_startTime:
             vals = value.split(":")
             startTimeHr = vals[0]
@@ -1227,6 +4216,125 @@ def main(argv, argc):
         sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
         quit()
 
+    importWorkersI = None
+    try:
+        importWorkersI = int(importWorkers)
+        if importWorkersI < 1:
+            raise ValueError(importWorkers)
+    except (TypeError, ValueError) as e:
+        error = (
+            "Number of import workers is not a valid number, application terminated."
+        )
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
+    userWorkersI = None
+    try:
+        userWorkersI = int(userWorkers)
+        if userWorkersI < 1:
+            raise ValueError(userWorkers)
+    except (TypeError, ValueError) as e:
+        error = "Number of user workers is not a valid number, application terminated."
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
+    importChunkSizeI = None
+    try:
+        importChunkSizeI = int(importChunkSize)
+        if importChunkSizeI < 1:
+            raise ValueError(importChunkSize)
+    except (TypeError, ValueError) as e:
+        error = (
+            "Number of files per import is not a valid number, application terminated."
+        )
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
+    copyWorkersI = None
+    try:
+        copyWorkersI = int(copyWorkers)
+        if copyWorkersI < 1:
+            raise ValueError(copyWorkers)
+    except (TypeError, ValueError) as e:
+        error = "Number of copy workers is not a valid number, application terminated."
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
+    metadataWorkersI = None
+    try:
+        metadataWorkersI = int(metadataWorkers)
+        if metadataWorkersI < 1:
+            raise ValueError(metadataWorkers)
+    except (TypeError, ValueError) as e:
+        error = (
+            "Number of metadata workers is not a valid number, application terminated."
+        )
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
+    b2ChunkSizeI = None
+    try:
+        b2ChunkSizeI = int(b2ChunkSize)
+        if b2ChunkSizeI < 5:
+            raise ValueError(b2ChunkSize)
+        b2ChunkSizeI = b2ChunkSizeI * 1024 * 1024
+    except (TypeError, ValueError) as e:
+        error = "Backblaze upload part size is not a valid number of MB (min 5), application terminated."
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
+    b2PartWorkersI = None
+    try:
+        b2PartWorkersI = int(b2PartWorkers)
+        if b2PartWorkersI < 1:
+            raise ValueError(b2PartWorkers)
+    except (TypeError, ValueError) as e:
+        error = "Number of backblaze part workers is not a valid number, application terminated."
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
+    b2FileWorkersI = None
+    try:
+        b2FileWorkersI = int(b2FileWorkers)
+        if b2FileWorkersI < 1:
+            raise ValueError(b2FileWorkers)
+    except (TypeError, ValueError) as e:
+        error = "Number of backblaze file workers is not a valid number, application terminated."
+        writeToLog("ERROR: " + error)
+        writeToLog(repr(e))
+        printToConsole("ERROR: " + error)
+        printToConsole(repr(e))
+        sendErrorEmail(emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW)
+        quit()
+
     if hasB2_g and (
         (b2AppKeyId_g == None) or (b2AppKey_g == None) or (b2BucketName_g == None)
     ):
@@ -1374,852 +4482,164 @@ def main(argv, argc):
     printToConsole(str(parameters))
     endTimePassed = False
 
-    fullImportedData = readPreviousImportedFile(localPath)
+    importedStore = ImportedStore(os.path.join(localPath, outputImportedStoreFileName))
+    migratePreviousImported(localPath, importedStore)
+    replayJournals(localPath, importedStore)
+    fingerprints = readFingerprintsFile(localPath)
+    if fingerprints == None or importedStore.isEmpty() or rescan:
+        fingerprints = {}
     currentImportedData = {}
+    datasetNameIndexes = {}
+    imageNameIndexes = {}
     targetPath = pathlib.Path(target).resolve()
-    for userPath in targetPath.iterdir():
-        if userPath.is_file():
-            continue
-        userFolder = userPath.name
-        currentImportedData[userFolder] = {}
-        userCurrentImportedData = currentImportedData[userFolder]
-        userFullImportedData = None
-        if fullImportedData != None and userFolder in fullImportedData:
-            userFullImportedData = fullImportedData[userFolder]
-        userName = None
-        userPSW = None
-        emailTo = None
-        destination = None
-        hasDelete = None
-        hasMMA = None
-        hasB2 = None
-        b2Endpoint = None
-        b2BucketName = None
-        b2AppKeyId = None
-        b2AppKey = None
-        uParameters = readConfigFile(userPath)
-        # Read user parameters
-        # if uParameters == None:
-        #     error = (
-        #         "Reading user parameters from config file failed, user folder "
-        #         + userPath
-        #         + " skipped."
-        #     )
-        #     writeToLog("ERROR: " + error)
-        #     printToConsole("ERROR: " + error)
-        #     sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
-        #     continue
-        if uParameters != None and uParameters != {}:
-            eKey = uParameters[p_key]
-            if eKey == None:
-                error = (
-                    "Reading encryption key for user parameters failed, user folder "
-                    + userPath
-                    + " skipped."
+    globalParams = {
+        p_omeroUsername: userName_g,
+        p_omeroPSW: userPSW_g,
+        p_isAdmin: isAdmin,
+        p_localPath: localPath,
+        p_omeroHostname: hostName,
+        p_omeroPort: portI,
+        p_target: target,
+        p_dest: destination_g,
+        p_delete: hasDelete_g,
+        p_dedupe: hasDedupe_g,
+        p_mma: hasMMA_g,
+        p_b2: hasB2_g,
+        p_b2_endpoint: b2Endpoint_g,
+        p_b2_bucketName: b2BucketName_g,
+        p_b2_appKeyId: b2AppKeyId_g,
+        p_b2_appKey: b2AppKey_g,
+        p_adminsEmail: adminsEmailTo,
+        p_emailFrom: emailFrom,
+        p_emailFromPSW: emailFromPSW,
+        p_startTime: (startTimeHr, startTimeMin),
+        p_endTime: (endTimeHr, endTimeMin),
+        p_importWorkers: importWorkersI,
+        p_importChunkSize: importChunkSizeI,
+        p_copyWorkers: copyWorkersI,
+        p_b2_chunkSize: b2ChunkSizeI,
+        p_b2_partWorkers: b2PartWorkersI,
+        p_b2_fileWorkers: b2FileWorkersI,
+    }
+    # Metadata worker processes are started once for the run, spawned rather
+    # than forked as the Omero connections and transfer pipelines run
+    # threads, they are used by the user folders imported in this process,
+    # user folder processes parse their metadata as they go
+    metadataExecutor = ProcessPoolExecutor(
+        max_workers=metadataWorkersI,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initWorkerFiles,
+        initargs=(outputLogFilePath, outputImportedFilePath),
+    )
+    if userWorkersI > 1:
+        # Each user folder is imported in its own process with its own
+        # connection, results are merged here as each user completes, the
+        # processes are spawned as the imported store is open and the
+        # metadata worker processes are started by now
+        userExecutor = ProcessPoolExecutor(
+            max_workers=userWorkersI,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initWorkerFiles,
+            initargs=(outputLogFilePath, outputImportedFilePath),
+        )
+        userFutures = {}
+        userPaths = [userPath for userPath in targetPath.iterdir() if userPath.is_dir()]
+        userIndex = 0
+        while True:
+            while (
+                not endTimePassed
+                and userIndex < len(userPaths)
+                and len(userFutures) < userWorkersI
+            ):
+                userPath = userPaths[userIndex]
+                userIndex = userIndex + 1
+                future = userExecutor.submit(
+                    importUserFolder,
+                    userPath,
+                    globalParams,
+                    importedStore.path,
+                    fingerprints.get(userPath.name),
+                    {},
+                    {},
                 )
-                writeToLog("ERROR: " + error)
-                printToConsole("ERROR: " + error)
-                sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
-                continue
-
-            f = Fernet(eKey)
-            for key in uParameters:
-                if key.startswith("#"):
-                    continue
-                value = uParameters[key]
-                if key == p_omeroUsername:
-                    userName = str(f.decrypt(value).decode())
-                if key == p_omeroPSW:
-                    userPSW = str(f.decrypt(value).decode())
-                if key == p_userEmail:
-                    emailTo = str(f.decrypt(value).decode())
-                if key == p_dest:
-                    destination = value
-                if key == p_delete:
-                    hasDelete = value
-                if key == p_mma:
-                    hasMMA = value
-                if key == p_b2:
-                    hasB2 = value
-                if key == p_b2_endpoint:
-                    b2Endpoint = str(f.decrypt(value).decode())
-                if key == p_b2_bucketName:
-                    b2BucketName = str(f.decrypt(value).decode())
-                if key == p_b2_appKeyId:
-                    b2AppKeyId = str(f.decrypt(value).decode())
-                if key == p_b2_appKey:
-                    b2AppKey = str(f.decrypt(value).decode())
-
-        if userName == None:
-            userName = userName_g
-        if userName == None:
-            error = (
-                "No Omero admin or user Username has not been specified, user folder "
-                + str(userPath)
-                + " skipped."
-            )
-            writeToLog("ERROR: " + error)
-            printToConsole("ERROR: " + error)
-            sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
-            continue
-
-        if userPSW == None:
-            userPSW = userPSW_g
-        if userPSW == None:
-            error = (
-                "No Omero admin or user Password has not been specified, user folder "
-                + str(userPath)
-                + " skipped."
-            )
-            writeToLog("ERROR: " + error)
-            printToConsole("ERROR: " + error)
-            sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
-            continue
-
-        # if emailTo == None:
-        #     error = (
-        #         "User email has not been specified, user folder "
-        #         + str(userPath)
-        #         + " skipped."
-        #     )
-        #     writeToLog("ERROR: " + error)
-        #     printToConsole("ERROR: " + error)
-        #     sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
-        #     continue
-
-        if destination != None:
-            try:
-                destPath = pathlib.Path(destination).resolve()
-                if not destPath.exists():
-                    error = (
-                        "User destination directory doesn't exists, user folder "
-                        + str(userPath)
-                        + " skipped."
-                    )
-                    writeToLog("ERROR: " + error)
-                    printToConsole("ERROR: " + error)
-                    sendErrorEmail(
-                        emailTo, adminsEmailTo, error, emailFrom, emailFromPSW
-                    )
-                    continue
-                if not destPath.is_dir():
-                    error = (
-                        "User destination directory is not a directory, user folder "
-                        + str(userPath)
-                        + " skipped."
-                    )
+                userFutures[future] = userPath.name
+            if len(userFutures) == 0:
+                break
+            doneFutures, notDoneFutures = wait(userFutures, return_when=FIRST_COMPLETED)
+            for future in doneFutures:
+                userFolder = userFutures.pop(future)
+                try:
+                    (
+                        userCurrentImportedData,
+                        userCurrentFingerprints,
+                        userEndTimePassed,
+                    ) = future.result()
+                except Exception as e:
+                    error = "Import failed for user folder " + userFolder
                     writeToLog("ERROR: " + error)
+                    writeToLog(repr(e))
                     printToConsole("ERROR: " + error)
+                    printToConsole(repr(e))
                     sendErrorEmail(
-                        emailTo, adminsEmailTo, error, emailFrom, emailFromPSW
+                        None, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW
                     )
+                    # keep what the user folder imported before failing
+                    replayJournal(localPath, userFolder, importedStore)
                     continue
-                # destination = tmpDest
-            except IOError as e:
-                error = (
-                    "Exception trying to determine if user destination directory exists and is a directory, user folder "
-                    + str(userPath)
-                    + " skipped."
-                )
-                writeToLog("ERROR: " + error)
-                writeToLog(repr(e))
-                printToConsole("ERROR: " + error)
-                printToConsole(repr(e))
-                sendErrorEmail(
-                    emailTo, adminsEmailTo, error + repr(e), emailFrom, emailFromPSW
-                )
-                continue
-        else:
-            destination = destination_g
-
-        if hasDelete == None:
-            hasDelete = hasDelete_g
-
-        if hasMMA == None:
-            hasMMA = hasMMA_g
-
-        if hasB2 != None:
-            if hasB2 and (
-                (b2AppKeyId == None) or (b2AppKey == None) or (b2BucketName == None)
-            ):
-                error = (
-                    "Some user bucket information for backblaze backup have not been specified, user folder "
-                    + str(userPath)
-                    + " skipped."
-                )
-                writeToLog("ERROR: " + error)
-                printToConsole("ERROR: " + error)
-                sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
-                quit()
-        else:
-            hasB2 = hasB2_g
-            b2Endpoint = b2Endpoint_g
-            b2BucketName = b2BucketName_g
-            b2AppKeyId = b2AppKeyId_g
-            b2AppKey = b2AppKey_g
-
-        printToConsole("USER PARAMETERS CONFIG INIT")
-        printToConsole(str(uParameters))
-
-        # Call function to return reference to B2 service
-        b2 = None
-        if hasB2:
-            b2 = get_b2_resource(b2Endpoint, b2AppKeyId, b2AppKey)
-        # Call function to return reference to B2 service
-        # b2_client = get_b2_client(b2Endpoint, b2AppKeyId, b2AppKey)
-
-        # conn = BlitzGateway(
-        #     userName, userPSW, host=hostName, port=portI, secure=True
-        # )
-        # conn.connect()
-        conn = ezome.connect(
-            host=hostName,
-            port=portI,
-            user=userName,
-            password=userPSW,
-            group="",
-            secure=True,
-        )
-
-        omeConnUser = conn.getUser()
-        omeConnUserName = omeConnUser.getName()
-        if conn == None:
-            error = "Connection error"
-            writeToLog("ERROR: " + error)
-            printToConsole("ERROR: " + error)
-            sendErrorEmail(emailTo, adminsEmailTo, error, emailFrom, emailFromPSW)
-            quit()
-        printToConsole("Connected")
-        printToConsole(str(conn))
-        conn.c.enableKeepAlive(60)
-        # conn.close(True)
-        # quit()
-
-        omeUserName = None
-        userConn = None
-        # userConn = None
-        if omeConnUserName.lower() != userFolder.lower() and isAdmin:
-            if conn.isFullAdmin():
-                omeUser = conn.getObject(
-                    "Experimenter", attributes={"omeName": userFolder}
-                )
-                omeUserName = omeUser.getName()
-                omeUserPSW = omeUser.getLdap()
-                print("OME USER PSW :  " + str(omeUserPSW))
-                quit()
-                # userConn = conn.suConn(omeUser.getName())
-                if emailTo == None:
-                    emailTo = omeUser.getEmail()
-                # message = "Admin switched to user " + omeUser.getName()
-                # writeToLog(message)
-                # printToConsole(message)
-            else:
-                error = (
-                    "Cannot find user "
-                    + userFolder
-                    + ", current connection doesn't have proper admin rights."
-                )
-                printToConsole(error)
-                writeToLog(error)
-                continue
-
-        # find group_id using group name ?
-        # userConn.SERVICE_OPTS.setOmeroGroup(group_id)
-        # session = userConn.getSession()
-        # Explore User Projects
-        hasNewImport = False
-        for projectPath in userPath.iterdir():
-            if projectPath.is_file():
-                continue
-            # projectCFolder = os.path.join(userFolder, projectPath.name)
-            if omeUserName != None:
-                userConn = conn.suConn(omeUserName)
-            else:
-                userConn = conn
-            data = None
-            namespace = omero.constants.metadata.NSCLIENTMAPANNOTATION
-            try:
-                data = collectMetadataFromExcel(projectPath)
-            except WrappedException as e:
-                error = e.message
-                writeToLog(error)
-                writeToLog(repr(e.exception))
-                sendErrorEmail(
-                    emailTo,
-                    adminsEmailTo,
-                    error + "\n" + repr(e.exception),
-                    emailFrom,
-                    emailFromPSW,
-                )
-            except Exception as e:
-                writeToLog(repr(e))
-                sendErrorEmail(
-                    emailTo,
-                    adminsEmailTo,
-                    repr(e),
-                    emailFrom,
-                    emailFromPSW,
+                currentImportedData[userFolder] = userCurrentImportedData
+                importedStore.putUserData(userFolder, userCurrentImportedData)
+                clearJournal(localPath, userFolder)
+                fingerprints[userFolder] = userCurrentFingerprints
+                if userEndTimePassed:
+                    endTimePassed = True
+        userExecutor.shutdown()
+    else:
+        userPaths = [userPath for userPath in targetPath.iterdir() if userPath.is_dir()]
+        for userIndex in range(0, len(userPaths)):
+            userPath = userPaths[userIndex]
+            userFolder = userPath.name
+            # the next user folder is parsed while this one is imported
+            prefetchPaths = None
+            if userIndex + 1 < len(userPaths):
+                nextUserPath = userPaths[userIndex + 1]
+                prefetchPaths = getChangedProjectPaths(
+                    nextUserPath, fingerprints.get(nextUserPath.name)
                 )
-            if data == None or data == {}:
-                continue
-            for projectKey in data:
-                project = data[projectKey]
-                projectFullImportedData = None
-                projectCurrentImportedData = None
-                if userFullImportedData != None and projectKey in userFullImportedData:
-                    projectFullImportedData = userFullImportedData[projectKey]
-                if projectKey not in userCurrentImportedData:
-                    currentImportedData[userFolder][projectKey] = {}
-                projectCurrentImportedData = currentImportedData[userFolder][projectKey]
-                projectID = None
-                omeProject = None
-                projectQName = os.path.join(userFolder, projectKey)
-                projectCurrentImportedData[import_path] = projectQName
-                if projectFullImportedData == None:
-                    omeProject = userConn.getObject(
-                        "Project", attributes={"name": projectKey}
-                    )
-                    if omeProject == None:
-                        newProject = ProjectWrapper(userConn, ProjectI())
-                        newProject.setName(projectKey)
-                        newProject.save()
-                        omeProject = newProject
-                        projectCurrentImportedData[import_status] = (
-                            import_status_imported
-                        )
-                        projectID = newProject._obj.id.val
-                        writeToLog(
-                            "Project created for "
-                            + projectQName
-                            + " ("
-                            + str(projectID)
-                            + ")"
-                        )
-                        hasNewImport = True
-                    else:
-                        projectID = omeProject._obj.id.val
-                        projectCurrentImportedData[import_status] = import_status_found
-                        writeToLog(
-                            "Project found for "
-                            + projectQName
-                            + " ("
-                            + str(projectID)
-                            + ")"
-                        )
-                else:
-                    projectID = projectFullImportedData[import_status_id]
-                    omeProject = userConn.getObject("Project", projectID)
-                    projectCurrentImportedData[import_status] = import_status_pimported
-                    writeToLog(
-                        "Project previously imported for "
-                        + projectQName
-                        + " ("
-                        + str(projectID)
-                        + ")"
-                    )
-
-                projectCurrentImportedData[import_status_id] = projectID
-
-                # TODO should we always update the annotation? or only if not previously imported?
-                # ATM only if not previously imported
-
-                projectKeyValueData = []
-                # projectKeyValueData = {}
-                # for projAnnKey in project:
-                #     if projAnnKey == metadata_datasets:
-                #         continue
-                #     projectKeyValueData.append([projAnnKey, project[projAnnKey]])
-                for moduleKey in project:
-                    if moduleKey == metadata_datasets or moduleKey == excel_module_ome:
-                        continue
-                    projectKeyValueData.append([moduleKey, ""])
-                    for projAnnKey in project[moduleKey]:
-                        value = project[moduleKey][projAnnKey]
-                        dataSplit = None
-                        if "description" not in projAnnKey.lower() and isinstance(
-                            value, str
-                        ):
-                            dataSplit = value.split(",")
-                        if dataSplit != None and len(dataSplit) > 1:
-                            for i in range(0, len(dataSplit)):
-                                projectKeyValueData.append(
-                                    [projAnnKey + "_" + str(i), str(dataSplit[i])]
-                                )
-                        else:
-                            projectKeyValueData.append([projAnnKey, str(value)])
-                if (
-                    projectFullImportedData == None
-                    or import_annotate not in projectFullImportedData
-                    # or projectFullImportedData[import_annotate] == False
-                ):
-                    if len(projectKeyValueData) > 0:
-                        newProjMapAnn = MapAnnotationWrapper(userConn)
-                        newProjMapAnn.setNs(namespace)
-                        newProjMapAnn.setValue(projectKeyValueData)
-                        # newProjMapAnn.setNs(moduleKey)
-                        # newProjMapAnn.setValue(projectKeyValueData[moduleKey])
-                        newProjMapAnn.save()
-                        omeProject.linkAnnotation(newProjMapAnn)
-                        projectCurrentImportedData[import_annotate] = (
-                            newProjMapAnn._obj.id.val
-                        )
-                        # if not import_annotate in projectCurrentImportedData:
-                        #     projectCurrentImportedData[import_annotate] = {}
-                        # projectCurrentImportedData[import_annotate][
-                        #     moduleKey
-                        # ] = newProjMapAnn._obj.id.val
-                        writeToLog(
-                            "Annotation created for "
-                            + projectQName
-                            + " ("
-                            + str(projectID)
-                            + ")"
-                        )
-                        # writeToLog(
-                        #     "Annotation created for "
-                        #     + projectQName
-                        #     + " - "
-                        #     + moduleKey
-                        #     + " ("
-                        #     + str(projectID)
-                        #     + ")"
-                        # )
-                        hasNewImport = True
-                else:
-                    if len(projectKeyValueData) > 0:
-                        projMapAnnID = projectFullImportedData[import_annotate]
-                        newProjMapAnn = userConn.getObject(
-                            "MapAnnotation", projMapAnnID
-                        )
-                        newProjMapAnn.setValue(projectKeyValueData)
-                        newProjMapAnn.save()
-                    writeToLog(
-                        "Annotation updated for "
-                        + projectQName
-                        + " ("
-                        + str(projectID)
-                        + ")"
-                    )
-                    hasNewImport = True
-
-                if omeUserName != None:
-                    userConn.close()
-
-                for datasetKey in project[metadata_datasets]:
-                    dataset = project[metadata_datasets][datasetKey]
-
-                    if omeUserName != None:
-                        userConn = conn.suConn(omeUserName)
-                        # userConn.c.enableKeepAlive(60)
-                    else:
-                        userConn = conn
-
-                    datasetFullImportedData = None
-                    datasetCurrentImportedData = None
-                    if (
-                        projectFullImportedData != None
-                        and datasetKey in projectFullImportedData
-                    ):
-                        datasetFullImportedData = projectFullImportedData[datasetKey]
-                    if datasetKey not in projectCurrentImportedData:
-                        projectCurrentImportedData[datasetKey] = {}
-                    datasetCurrentImportedData = projectCurrentImportedData[datasetKey]
-                    datasetID = None
-                    omeDataset = None
-                    datasetQName = os.path.join(projectQName, datasetKey)
-                    datasetCurrentImportedData[import_path] = datasetQName
-                    if datasetFullImportedData == None:
-                        dsIDs = ezome.get_dataset_ids(userConn, project=projectID)
-                        omeDataset = None
-                        for dsID in dsIDs:
-                            omeDS = userConn.getObject("Dataset", dsID)
-                            if omeDS.getName() == datasetKey:
-                                omeDataset = omeDS
-                        # omeDataset = userConn.getObject(
-                        #     "Dataset", attributes={"name": datasetKey}
-                        # )
-                        if omeDataset == None:
-                            newDataset = DatasetWrapper(userConn, DatasetI())
-                            newDataset.setName(datasetKey)
-                            newDataset.save()
-                            omeDataset = newDataset
-                            datasetID = newDataset._obj.id.val
-                            link = ProjectDatasetLinkI()
-                            link.setChild(DatasetI(datasetID, False))
-                            link.setParent(ProjectI(projectID, False))
-                            userConn.getUpdateService().saveObject(link)
-                            datasetCurrentImportedData[import_status] = (
-                                import_status_imported
-                            )
-                            writeToLog(
-                                "Dataset created for "
-                                + datasetQName
-                                + " ("
-                                + str(datasetID)
-                                + ")"
-                            )
-                            hasNewImport = True
-                        else:
-                            datasetID = omeDataset._obj.id.val
-                            datasetCurrentImportedData[import_status] = (
-                                import_status_found
-                            )
-                            writeToLog(
-                                "Dataset found for "
-                                + datasetQName
-                                + " ("
-                                + str(datasetID)
-                                + ")"
-                            )
-                    else:
-                        datasetID = datasetFullImportedData[import_status_id]
-                        omeDataset = userConn.getObject("Dataset", datasetID)
-                        datasetCurrentImportedData[import_status] = (
-                            import_status_pimported
-                        )
-                        writeToLog(
-                            "Dataset previously imported for "
-                            + datasetQName
-                            + " ("
-                            + str(datasetID)
-                            + ")"
-                        )
-
-                    datasetCurrentImportedData[import_status_id] = datasetID
-
-                    datasetKeyValueData = []
-                    # for dsAnnKey in dataset:
-                    #     if dsAnnKey == metadata_images:
-                    #         continue
-                    #     datasetKeyValueData.append([dsAnnKey, dataset[dsAnnKey]])
-                    for moduleKey in dataset:
-                        if (
-                            moduleKey == metadata_images
-                            or moduleKey == excel_module_ome
-                        ):
-                            continue
-                        datasetKeyValueData.append([moduleKey, ""])
-                        for dsAnnKey in dataset[moduleKey]:
-                            value = dataset[moduleKey][dsAnnKey]
-                            dataSplit = None
-                            if "description" not in dsAnnKey.lower() and isinstance(
-                                value, str
-                            ):
-                                dataSplit = value.split(",")
-                            if dataSplit != None and len(dataSplit) > 1:
-                                for i in range(0, len(dataSplit)):
-                                    datasetKeyValueData.append(
-                                        [dsAnnKey + "_" + str(i), str(dataSplit[i])]
-                                    )
-                            else:
-                                datasetKeyValueData.append([dsAnnKey, str(value)])
-                    if (
-                        datasetFullImportedData == None
-                        or import_annotate not in datasetFullImportedData
-                        # or datasetFullImportedData[import_annotate] == False
-                    ):
-                        if len(datasetKeyValueData) > 0:
-                            newDsMapAnn = MapAnnotationWrapper(userConn)
-                            newDsMapAnn.setNs(namespace)
-                            newDsMapAnn.setValue(datasetKeyValueData)
-                            newDsMapAnn.save()
-                            omeDataset.linkAnnotation(newDsMapAnn)
-                            datasetCurrentImportedData[import_annotate] = (
-                                newDsMapAnn._obj.id.val
-                            )
-                            writeToLog(
-                                "Annotation created for "
-                                + datasetQName
-                                + " ("
-                                + str(datasetID)
-                                + ")"
-                            )
-                            hasNewImport = True
-                        else:
-                            if len(datasetKeyValueData) > 0:
-                                dsMapAnnID = datasetFullImportedData[import_annotate]
-                                newDsMapAnn = userConn.getObject(
-                                    "MapAnnotation", dsMapAnnID
-                                )
-                                newDsMapAnn.setValue(datasetKeyValueData)
-                            writeToLog(
-                                "Annotation updated for "
-                                + datasetQName
-                                + " ("
-                                + str(datasetID)
-                                + ")"
-                            )
-                            hasNewImport = True
-
-                    if omeUserName != None:
-                        userConn.close()
-
-                    for image in dataset[metadata_images]:
-                        # TODO: add time check somewhere below here
-
-                        if omeUserName != None:
-                            userConn = conn.suConn(omeUserName)
-                            # userConn.c.enableKeepAlive(60)
-                        else:
-                            userConn = conn
-
-                        printToConsole("image metadata")
-                        printToConsole(str(image))
-
-                        imageName = image[metadata_image_name]
-                        imageNewName = image[metadata_image_new_name]
-                        imagePath = image[metadata_image_path]
-                        imageTags = None
-                        if metadata_image_tags1 in image:
-                            imageTags = image[metadata_image_tags1]
-                        elif metadata_image_tags2 in image:
-                            imageTags = image[metadata_image_tags2]
-                        else:
-                            # TODO issue, raise
-                            imageTags = []
-                        # imageFolderPath = image["Image_Path"]
-                        # imagePath = os.path.join(imageFolderPath, imageName)
-
-                        imageFullImportedData = None
-                        imageCurrentImportedData = None
-                        if (
-                            datasetFullImportedData != None
-                            and imageName in datasetFullImportedData
-                        ):
-                            imageFullImportedData = datasetFullImportedData[imageName]
-                        if imageName not in datasetCurrentImportedData:
-                            datasetCurrentImportedData[imageName] = {}
-                        imageCurrentImportedData = datasetCurrentImportedData[imageName]
-                        imageID = None
-                        omeImage = None
-                        imageQName = imagePath.replace(target, "")[1:]
-                        # imageQName = os.path.join(datasetQName, relImagePath)
-                        imageCurrentImportedData[import_path] = imageQName
-                        if imageFullImportedData == None:
-                            omeImage = None
-                            imgIDs = ezome.get_image_ids(userConn, dataset=datasetID)
-                            for imgID in imgIDs:
-                                omeImg = userConn.getObject("Image", imgID)
-                                if omeImg.getName() == imageNewName:
-                                    omeImage = omeImg
-                            # omeImage = userConn.getObject(
-                            #     "Image", attributes={"name": imageNewName}
-                            # )
-                            if omeImage == None:
-                                imageID = ezome.ezimport(
-                                    userConn,
-                                    imagePath,
-                                    projectID,
-                                    datasetID,
-                                )[0]
-                                newImage = userConn.getObject("Image", imageID)
-                                newImage.setName(imageNewName)
-                                newImage.save()
-                                omeImage = newImage
-                                imageCurrentImportedData[import_status] = (
-                                    import_status_imported
-                                )
-                                imageID = newImage._obj.id.val
-                                writeToLog(
-                                    "Image imported for "
-                                    + imageQName
-                                    + " ("
-                                    + str(imageID)
-                                    + ")"
-                                )
-                                hasNewImport = True
-                                if destination != None:
-                                    imageCopyPath = imagePath.replace(
-                                        target, destination
-                                    )
-                                    imageCopyFolderPath = imageCopyPath.replace(
-                                        imageName, ""
-                                    )
-                                    os.makedirs(imageCopyFolderPath, exist_ok=True)
-                                    # TODO copy mma file here?
-                                    # TODO regex imageName*.json?
-                                    shutil.copy2(imagePath, imageCopyFolderPath)
-                                    writeToLog("Image copied for " + imageQName)
-                                if hasB2:
-                                    try:
-                                        response = upload_file(
-                                            b2BucketName,
-                                            imagePath,
-                                            imageName,
-                                            b2,
-                                            imageQName,
-                                        )
-                                        printToConsole("RESPONSE:  " + str(response))
-                                        # generate_friendly_url(NEW_BUCKET_NAME, endpoint, b2)
-                                    except ClientError as e:
-                                        error = (
-                                            "Client error during backblaze upload for "
-                                            + imageQName
-                                        )
-                                        writeToLog("ERROR: " + error)
-                                        writeToLog(repr(e))
-                                        printToConsole("ERROR: " + error)
-                                        printToConsole(repr(e))
-                                        sendErrorEmail(
-                                            emailTo,
-                                            adminsEmailTo,
-                                            error + repr(e),
-                                            emailFrom,
-                                            emailFromPSW,
-                                        )
-
-                                if hasDelete:
-                                    # TODO directories not removed because of CSV and MMA files?
-                                    os.remove(imagePath)
-
-                            else:
-                                imageID = omeImage._obj.id.val
-                                imageCurrentImportedData[import_status] = (
-                                    import_status_found
-                                )
-                                writeToLog(
-                                    "Image found for "
-                                    + imageQName
-                                    + " ("
-                                    + str(imageID)
-                                    + ")"
-                                )
-                        else:
-                            imageID = imageFullImportedData[import_status_id]
-                            omeImage = userConn.getObject("Image", imageID)
-                            imageID = omeImage._obj.id.val
-                            imageCurrentImportedData[import_status] = (
-                                import_status_pimported
-                            )
-                            writeToLog(
-                                "Image previously imported for "
-                                + imageQName
-                                + " ("
-                                + str(imageID)
-                                + ")"
-                            )
-
-                        imageCurrentImportedData[import_status_id] = imageID
-
-                        imageKeyValueData = []
-                        for imgAnnKey in image:
-                            if (
-                                imgAnnKey == metadata_image_new_name
-                                or imgAnnKey == metadata_image_path
-                                or imgAnnKey == metadata_image_mma
-                                or imgAnnKey == metadata_image_tags1
-                                or imgAnnKey == metadata_image_tags2
-                            ):
-                                continue
-                            imageKeyValueData.append([imgAnnKey, str(image[imgAnnKey])])
-                        if (
-                            imageFullImportedData == None
-                            or import_annotate not in imageFullImportedData
-                            # or imageFullImportedData[import_annotate] == False
-                        ):
-                            if len(imageKeyValueData) > 0:
-                                newImgMapAnn = MapAnnotationWrapper(userConn)
-                                newImgMapAnn.setNs(namespace)
-                                newImgMapAnn.setValue(imageKeyValueData)
-                                newImgMapAnn.save()
-                                omeImage.linkAnnotation(newImgMapAnn)
-                                writeToLog(
-                                    "Annotation created for "
-                                    + imageQName
-                                    + " ("
-                                    + str(imageID)
-                                    + ")"
-                                )
-                            if len(imageTags) > 0:
-                                for imgTag in imageTags:
-                                    omeTags = userConn.getObjects(
-                                        "TagAnnotation",
-                                        attributes={"textValue": imgTag},
-                                    )
-                                    omeTagAnn = None
-                                    for omeTagTmp in omeTags:
-                                        omeTagAnn = omeTagTmp
-                                        break
-                                    if omeTagAnn == None:
-                                        newImgTagAnn = TagAnnotationWrapper(userConn)
-                                        newImgTagAnn.setValue(imgTag)
-                                        newImgTagAnn.save()
-                                        omeTagAnn = newImgTagAnn
-                                    omeImage.linkAnnotation(omeTagAnn)
-                                writeToLog(
-                                    "Tags created for "
-                                    + imageQName
-                                    + " ("
-                                    + str(imageID)
-                                    + ")"
-                                )
-                            imageCurrentImportedData[import_annotate] = (
-                                newImgMapAnn._obj.id.val
-                            )
-                            hasNewImport = True
-                        else:
-                            if len(imageKeyValueData) > 0:
-                                imgMapAnnID = imageFullImportedData[import_annotate]
-                                newImgMapAnn = userConn.getObject(
-                                    "MapAnnotation", imgMapAnnID
-                                )
-                                newImgMapAnn.setValue(imageKeyValueData)
-                            writeToLog(
-                                "Annotation updated for "
-                                + imageQName
-                                + " ("
-                                + str(imageID)
-                                + ")"
-                            )
-                            hasNewImport = True
-
-                        if (
-                            startTimeHr != None
-                            and startTimeMin != None
-                            and endTimeHr != None
-                            and endTimeMin != None
-                        ):
-                            now = datetime.now()
-                            if now.hour < startTimeHr and now.hour > endTimeHr:
-                                endTimePassed = True
-                            if now.hour == endTimeHr and now.minute > endTimeMin:
-                                endTimePassed = True
-                            if now.hour == startTimeHr and now.minute < startTimeMin:
-                                endTimePassed = True
-
-                        if omeUserName != None:
-                            userConn.close()
-
-                        if endTimePassed:
-                            break
-                    if endTimePassed:
-                        break
-                if endTimePassed:
-                    break
+            (
+                userCurrentImportedData,
+                userCurrentFingerprints,
+                endTimePassed,
+            ) = importUserFolder(
+                userPath,
+                globalParams,
+                importedStore.path,
+                fingerprints.get(userFolder),
+                datasetNameIndexes,
+                imageNameIndexes,
+                None,
+                prefetchPaths,
+                metadataExecutor,
+            )
+            currentImportedData[userFolder] = userCurrentImportedData
+            importedStore.putUserData(userFolder, userCurrentImportedData)
+            clearJournal(localPath, userFolder)
+            fingerprints[userFolder] = userCurrentFingerprints
             if endTimePassed:
                 break
 
-        sendCompleteEmail(
-            emailTo,
-            adminsEmailTo,
-            hasNewImport,
-            currentImportedData[userFolder],
-            emailFrom,
-            emailFromPSW,
+    writeImportedData(localPath, currentImportedData, fingerprints)
+    if watch:
+        watchTarget(
+            targetPath,
+            localPath,
+            globalParams,
+            importedStore,
+            currentImportedData,
+            fingerprints,
+            metadataExecutor,
         )
-
-        conn.close()
-        printToConsole("Close connection")
-        if endTimePassed:
-            break
-
-    writeCurrentImported(currentImportedData)
-    if fullImportedData != None:
-        mergedImportedData = mergeDictionaries(currentImportedData, fullImportedData)
-    else:
-        mergedImportedData = deepCopyDictionary(currentImportedData)
-    printToConsole("mergedImportedData " + str(mergedImportedData))
-    writePreviousImported(localPath, mergedImportedData)
+    metadataExecutor.shutdown()
+    importedStore.close()
 
 
 if __name__ == "__main__":
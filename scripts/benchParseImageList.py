@@ -0,0 +1,121 @@
+import datetime
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import omeroImporter
+
+# Check parseImageListSpreadsheetData gives the records of the row by row
+# parser it replaced, then time both on a large image list:
+# python scripts/benchParseImageList.py [rows], default is 10000 rows
+
+excel_replaceNaN = omeroImporter.excel_replaceNaN
+metadata_image_tags1 = omeroImporter.metadata_image_tags1
+metadata_image_tags2 = omeroImporter.metadata_image_tags2
+
+
+# The row by row parser, it was given the sheet with the empty cells filled
+def parseImageListSpreadsheetDataByRow(ssData):
+    data = []
+    keys = ssData.columns
+    size = len(ssData[keys[0]])
+    for i in range(0, size):
+        objectData = {}
+        for key in keys:
+            if key == excel_replaceNaN:
+                continue
+            value = ssData[key][i]
+            if key == metadata_image_tags1 or key == metadata_image_tags2:
+                if value == excel_replaceNaN:
+                    value = []
+                else:
+                    values = value.split(",")
+                    value = values
+            if value == excel_replaceNaN:
+                continue
+            if isinstance(value, str):
+                value = value.strip()
+            objectData[key] = value
+        if objectData != None and objectData != {}:
+            data.append(objectData)
+    return data
+
+
+# Return an image list sheet of the given rows, with empty cells in most
+# columns and object columns holding no strings, as read by openpyxl
+def getImageListSheet(rows, seed=0):
+    random = np.random.default_rng(seed)
+
+    def getColumn(values, emptyRatio):
+        return [
+            values[i % len(values)] if random.random() > emptyRatio else np.nan
+            for i in range(rows)
+        ]
+
+    return pd.DataFrame(
+        {
+            "Image_Name": ["  img" + str(i) + ".tif " for i in range(rows)],
+            "New_Image_Name": ["image" + str(i) for i in range(rows)],
+            "Image_Path": ["/target/user/project/img" + str(i) for i in range(rows)],
+            metadata_image_tags1: getColumn(["a,b", " c ,d", "e"], 0.4),
+            metadata_image_tags2: [np.nan] * rows,
+            "Microscope": getColumn(["Zeiss", "  Nikon", "Leica  "], 0.2),
+            "Exposure": getColumn([1.5, 2.0, 3.25], 0.3),
+            "Count": list(range(rows)),
+            "Date": [datetime.datetime(2024, 1, 1 + i % 28) for i in range(rows)],
+            "Mixed": getColumn(["x", 5, 2.5, " y "], 0.5),
+            "Empty": [np.nan] * rows,
+            "Note": getColumn(["   ", "", " note "], 0.6),
+            "Time": getColumn([datetime.time(9, 30), datetime.time(17, 5)], 0.3),
+            "Flag": getColumn([True, False], 0.5),
+            "Objects": getColumn([" s ", 4, datetime.time(1, 1), True], 0.3),
+        }
+    )
+
+
+def checkEquivalence():
+    for rows in [0, 1, 7, 300]:
+        ssData = getImageListSheet(rows, rows)
+        if rows == 7:
+            # an empty row is left out
+            ssData.iloc[3] = np.nan
+        expected = parseImageListSpreadsheetDataByRow(ssData.fillna(excel_replaceNaN))
+        for sheet in [ssData, ssData.fillna(excel_replaceNaN)]:
+            data = omeroImporter.parseImageListSpreadsheetData(sheet)
+            if data != expected:
+                print("FAILED equivalence for " + str(rows) + " rows")
+                sys.exit(1)
+    print("PASSED equivalence")
+
+
+def getBestTime(function, ssData, runs=3):
+    times = []
+    for i in range(0, runs):
+        start = time.perf_counter()
+        function(ssData)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(argv):
+    rows = 10000
+    if len(argv) > 1:
+        rows = int(argv[1])
+    checkEquivalence()
+    ssData = getImageListSheet(rows)
+    byRowTime = getBestTime(
+        parseImageListSpreadsheetDataByRow, ssData.fillna(excel_replaceNaN)
+    )
+    byColumnTime = getBestTime(omeroImporter.parseImageListSpreadsheetData, ssData)
+    print("Rows: " + str(rows))
+    print("By row: %.3fs" % byRowTime)
+    print("By column: %.3fs" % byColumnTime)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,134 @@
+import os
+import pathlib
+import sys
+import tempfile
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import omeroImporter
+
+# Check the resume of the backblaze uploads against a local S3 server, such as
+# MinIO or moto_server, with the -b2 value of the importer:
+# python scripts/checkB2Resume.py http://localhost:9000#bucket#keyId#key
+# the S3 minimum part size is 5MB, the test file holds 3 parts and a half
+
+chunkSize = 5 * 1024 * 1024
+
+
+class Interrupted(Exception):
+    pass
+
+
+# Upload a file failing at a part, the upload is left unfinished
+def uploadInterrupted(bucketName, filePath, b2, remotePath, failPartNumber):
+    upload_part = omeroImporter.upload_part
+
+    def failingUploadPart(
+        b2_client, bucketName, remotePath, uploadID, partNumber, data
+    ):
+        if partNumber == failPartNumber:
+            raise Interrupted()
+        return upload_part(
+            b2_client, bucketName, remotePath, uploadID, partNumber, data
+        )
+
+    omeroImporter.upload_part = failingUploadPart
+    try:
+        omeroImporter.upload_file(
+            bucketName, filePath, os.path.basename(filePath), b2, remotePath, chunkSize
+        )
+    except Interrupted:
+        pass
+    finally:
+        omeroImporter.upload_part = upload_part
+
+
+# Upload a file counting the parts sent, returns the checksum and the count
+def uploadCounted(bucketName, filePath, b2, remotePath):
+    upload_part = omeroImporter.upload_part
+    partNumbers = []
+
+    def countingUploadPart(
+        b2_client, bucketName, remotePath, uploadID, partNumber, data
+    ):
+        partNumbers.append(partNumber)
+        return upload_part(
+            b2_client, bucketName, remotePath, uploadID, partNumber, data
+        )
+
+    omeroImporter.upload_part = countingUploadPart
+    try:
+        response, checksum = omeroImporter.upload_file(
+            bucketName, filePath, os.path.basename(filePath), b2, remotePath, chunkSize
+        )
+    finally:
+        omeroImporter.upload_part = upload_part
+    return checksum, len(partNumbers)
+
+
+def getObjectContent(b2, bucketName, remotePath):
+    response = b2.meta.client.get_object(Bucket=bucketName, Key=remotePath)
+    return response["Body"].read()
+
+
+def check(name, passed):
+    print(("PASSED " if passed else "FAILED ") + name)
+    return passed
+
+
+def main(argv):
+    endpoint, bucketName, keyID, applicationKey = argv[1].split("#")
+    omeroImporter.initWorkerFiles(os.devnull, None)
+    b2 = omeroImporter.get_b2_resource(endpoint, keyID, applicationKey)
+    if b2.Bucket(bucketName).creation_date == None:
+        b2.create_bucket(Bucket=bucketName)
+    folderPath = tempfile.mkdtemp()
+    filePath = os.path.join(folderPath, "image.tif")
+    data = os.urandom(3 * chunkSize + chunkSize // 2)
+    with open(filePath, "wb") as f:
+        f.write(data)
+    passed = True
+
+    # an interrupted upload is resumed from the parts already sent
+    remotePath = "checkB2Resume/resumed.tif"
+    uploadInterrupted(bucketName, filePath, b2, remotePath, 3)
+    checksum, partCount = uploadCounted(bucketName, filePath, b2, remotePath)
+    passed &= check("upload resumed", partCount == 2)
+    passed &= check(
+        "resumed object content", getObjectContent(b2, bucketName, remotePath) == data
+    )
+    passed &= check(
+        "upload complete",
+        omeroImporter.isUploadComplete(bucketName, filePath, remotePath, b2, checksum),
+    )
+
+    # a source changed with the same size is not taken as uploaded
+    changedData = bytearray(data)
+    changedData[0] ^= 0xFF
+    changedData = bytes(changedData)
+    with open(filePath, "wb") as f:
+        f.write(changedData)
+    passed &= check(
+        "changed source not complete",
+        not omeroImporter.isUploadComplete(bucketName, filePath, remotePath, b2, None),
+    )
+
+    # parts sent for a source changed since are not resumed
+    remotePath = "checkB2Resume/restarted.tif"
+    with open(filePath, "wb") as f:
+        f.write(data)
+    uploadInterrupted(bucketName, filePath, b2, remotePath, 3)
+    with open(filePath, "wb") as f:
+        f.write(changedData)
+    checksum, partCount = uploadCounted(bucketName, filePath, b2, remotePath)
+    passed &= check("upload restarted", partCount == 4)
+    passed &= check(
+        "restarted object content",
+        getObjectContent(b2, bucketName, remotePath) == changedData,
+    )
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
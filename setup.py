@@ -11,9 +11,12 @@ setup(
         "boto3>=1.34.79",
         "botocore>=1.34.79",
         "pandas>=2.2.2",
+        "numpy>=1.23.2",
         "xlrd>=2.0.1",
+        "openpyxl>=3.1.2",
         "cryptography>=42.0.5",
         "ezomero>=3.0.0",
+        "PyYAML>=6.0",
     ],
     include_package_data=True,
     zip_safe=False,